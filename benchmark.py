@@ -0,0 +1,299 @@
+import rosbag2_py
+from rclpy.serialization import serialize_message
+from builtin_interfaces.msg import Time
+from sensor_msgs.msg import Image, CompressedImage, PointCloud2, PointField, NavSatFix
+from geometry_msgs.msg import TwistStamped
+import cv2
+import numpy as np
+
+import argparse
+import subprocess
+import hashlib
+import json
+import time
+import sys
+import os
+import shutil
+
+from parse_ros2bag import ROS2BagParser, log_and_print
+
+# scenarios run every stage on its own (with what it needs) and then the whole pipeline
+SCENARIOS = {
+        'export': dict(topics='image'),
+        'pointcloud': dict(topics='pointcloud'),
+        'misc': dict(topics='misc'),
+        'sync': dict(topics='image', sync=True),
+        'zip': dict(topics='image', zip_=True),
+        # throughput of the stock model, people only
+        'blur': dict(topics='image', blur=True, blur_classes=[0]),
+        'preview': dict(topics='image', preview=True),
+        'full': dict(topics='all', sync=True, zip_=True, preview=True),
+        }
+# blurring needs the model, it is only run when asked for
+DEFAULT_SCENARIOS = [s for s in SCENARIOS if s != 'blur']
+STEM = {'image': ('image_raw', 'image_compressed'), 'pointcloud': ('points',), 'misc': ('fix', 'twist')}
+
+
+def stamp(t):
+    ns = int(round(t * 1e9))
+    return Time(sec=ns // 1000000000, nanosec=ns % 1000000000)
+
+
+def bag_topics(args):
+    # topic name -> message type of the synthetic bag
+    topics = {}
+    for i in range(args.raw_cameras):
+        topics[f'camera_{i}/image_raw'] = 'sensor_msgs/msg/Image'
+    for i in range(args.compressed_cameras):
+        topics[f'camera_{args.raw_cameras + i}/image_compressed'] = 'sensor_msgs/msg/CompressedImage'
+    if args.points:
+        topics['lidar/points'] = 'sensor_msgs/msg/PointCloud2'
+    if args.misc_rate:
+        topics['gps/fix'] = 'sensor_msgs/msg/NavSatFix'
+        topics['vehicle/twist'] = 'geometry_msgs/msg/TwistStamped'
+    return topics
+
+
+def topic_kind(name):
+    return next(kind for kind, stems in STEM.items() if name.rsplit('/', 1)[1] in stems)
+
+
+def generate_bag(args, path):
+    width, height = args.resolution
+    topics = bag_topics(args)
+    log_and_print(f'Generating {args.duration}s bag with {len(topics)} topics in {path}')
+
+    # a gradient that moves every frame, a few jpegs of it are reused for the compressed cameras
+    x, y = np.meshgrid(np.arange(width), np.arange(height))
+    base = np.dstack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)]).astype(np.uint8)
+    jpegs = [cv2.imencode('.jpg', np.roll(base, i * width // 8, axis=1))[1].tobytes() for i in range(8)]
+    rng = np.random.default_rng(0)
+    cloud = rng.uniform(-50, 50, (args.points, 4)).astype(np.float32)
+    fields = [PointField(name=n, offset=4 * i, datatype=PointField.FLOAT32, count=1)
+              for i, n in enumerate(('x', 'y', 'z', 'intensity'))]
+
+    def message(name, msg_type, i, t):
+        if msg_type == 'sensor_msgs/msg/Image':
+            msg = Image(height=height, width=width, encoding='bgr8', step=width * 3)
+            msg.data = np.roll(base, i * 8, axis=1).tobytes()
+        elif msg_type == 'sensor_msgs/msg/CompressedImage':
+            msg = CompressedImage(format='jpeg', data=jpegs[i % len(jpegs)])
+        elif msg_type == 'sensor_msgs/msg/PointCloud2':
+            msg = PointCloud2(height=1, width=args.points, fields=fields, is_bigendian=False, point_step=16,
+                              row_step=16 * args.points, is_dense=True)
+            msg.data = np.roll(cloud, i, axis=0).tobytes()
+        elif msg_type == 'sensor_msgs/msg/NavSatFix':
+            msg = NavSatFix(latitude=48.0 + i * 1e-6, longitude=11.0 + i * 1e-6, altitude=500.0)
+        else:
+            msg = TwistStamped()
+            msg.twist.linear.x = 10.0 + np.sin(i / 10)
+        msg.header.stamp = stamp(t)
+        msg.header.frame_id = name.split('/')[0]
+        return serialize_message(msg)
+
+    rates = {'image': args.frame_rate, 'pointcloud': args.pointcloud_rate, 'misc': args.misc_rate}
+    # every message of the bag in recording order
+    events = sorted((i / rates[topic_kind(name)], name, i) for name in topics
+                    for i in range(int(args.duration * rates[topic_kind(name)])))
+
+    writer = rosbag2_py.SequentialWriter()
+    writer.open(rosbag2_py.StorageOptions(uri=path, storage_id=args.storage),
+                rosbag2_py.ConverterOptions('cdr', 'cdr'))
+    for name, msg_type in topics.items():
+        writer.create_topic(rosbag2_py.TopicMetadata(name='/' + name, type=msg_type, serialization_format='cdr'))
+
+    start = 1700000000.0
+    sizes = dict.fromkeys(topics, 0)
+    counts = dict.fromkeys(topics, 0)
+    for t, name, i in events:
+        data = message(name, topics[name], i, start + t)
+        writer.write('/' + name, data, int((start + t) * 1e9))
+        sizes[name] += len(data)
+        counts[name] += 1
+    del writer
+
+    with open(os.path.join(path, 'benchmark.json'), 'w') as f:
+        json.dump({'topics': topics, 'sizes': sizes, 'counts': counts}, f, indent=2)
+
+
+def bag_config(args):
+    return {'raw_cameras': args.raw_cameras, 'compressed_cameras': args.compressed_cameras,
+            'resolution': list(args.resolution), 'frame_rate': args.frame_rate, 'duration': args.duration,
+            'points': args.points, 'pointcloud_rate': args.pointcloud_rate, 'misc_rate': args.misc_rate,
+            'storage': args.storage}
+
+
+def prepare_bag(args):
+    # bags are reused by later runs with the same settings
+    config = bag_config(args)
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+    path = os.path.join(os.path.realpath(args.output_dir), f'bag_{key}')
+    if not os.path.isfile(os.path.join(path, 'benchmark.json')):
+        shutil.rmtree(path, ignore_errors=True)
+        generate_bag(args, path)
+    return path
+
+
+def run_scenario(bag, output_path, name, export_workers=None):
+    # runs in its own process, so memory and pools of one scenario don't carry over to the next
+    scenario = SCENARIOS[name]
+    with open(os.path.join(bag, 'benchmark.json')) as f:
+        info = json.load(f)
+    topics = [t for t in info['topics'] if scenario['topics'] in ('all', topic_kind(t))]
+    images = [t for t in info['topics'] if topic_kind(t) == 'image']
+    preview = images[:4] if scenario.get('preview') else []
+
+    shutil.rmtree(output_path, ignore_errors=True)
+    bag_parser = ROS2BagParser(bag, output_path,
+                               blur=scenario.get('blur', False), blur_classes=scenario.get('blur_classes'),
+                               keep=False, zip_=scenario.get('zip_', False),
+                               sync=scenario.get('sync', False), sync_slop=0.01,
+                               sync_topics=images if scenario.get('sync') else [],
+                               topic_blacklist=[t for t in info['topics'] if t not in topics],
+                               preview_config=None, preview_topics=preview,
+                               preview_cols=2, preview_rows=(len(preview) + 1) // 2,
+                               preview_image_width=None, preview_image_height=None,
+                               ffmpeg_options='', ffmpeg_input_options='',
+                               ffmpeg_output_options='-c:v libx264 -preset ultrafast -pix_fmt yuv420p',
+                               logger=None, export_workers=export_workers,
+                               # the index is built in every run, as in a first run over a bag
+                               index_dir=os.path.join(output_path, 'index'))
+    start = time.monotonic()
+    bag_parser.parse_ros2bag()
+    wall_time = time.monotonic() - start
+
+    with open(os.path.join(output_path, 'profile.json')) as f:
+        profile = json.load(f)['stages']
+    frames = sum(info['counts'][t] for t in topics)
+    size = sum(info['sizes'][t] for t in topics)
+    stages = {}
+    for stage, metrics in profile.items():
+        count = sum(v for k, v in metrics['counts'].items() if k != 'busy_time')
+        # background pipelines are rated by the time they were busy
+        busy = metrics['counts'].get('busy_time') or metrics.get('wall_time')
+        stages[stage] = {'wall_time': metrics.get('wall_time'), 'busy_time': metrics['counts'].get('busy_time'),
+                         'count': count, 'per_second': count / busy if count and busy else None}
+    return {'wall_time': wall_time,
+            'frames': frames,
+            'frames_per_second': frames / wall_time,
+            'mb_per_second': size / 1e6 / wall_time,
+            'peak_rss_mb': max((m.get('peak_rss', 0) for m in profile.values()), default=0) / 1e6,
+            'stages': stages}
+
+
+def compare(results, baseline, tolerance):
+    # slower throughput or more memory than the baseline by more than the tolerance is a regression
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        for metric, higher_is_better in (('frames_per_second', True), ('mb_per_second', True), ('peak_rss_mb', False)):
+            if not base.get(metric):
+                continue
+            change = result[metric] / base[metric] - 1
+            regressed = -change > tolerance if higher_is_better else change > tolerance
+            print(f'{name:12} {metric:18} {base[metric]:12.2f} -> {result[metric]:12.2f} {change:+8.1%}'
+                  f'{"  REGRESSION" if regressed else ""}')
+            if regressed:
+                regressions.append((name, metric))
+    return regressions
+
+
+def print_results(results):
+    print(f'{"scenario":12} {"wall s":>8} {"frames/s":>10} {"MB/s":>8} {"peak MB":>8}')
+    for name, result in results.items():
+        print(f'{name:12} {result["wall_time"]:8.2f} {result["frames_per_second"]:10.1f} '
+              f'{result["mb_per_second"]:8.1f} {result["peak_rss_mb"]:8.0f}')
+        for stage, metrics in result['stages'].items():
+            rate = f'{metrics["per_second"]:10.1f}/s' if metrics['per_second'] else ''
+            print(f'  {stage:10} {metrics["wall_time"] or metrics["busy_time"] or 0:8.2f} {rate}')
+
+
+def resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark parse_ros2bag.py on synthetic bags.')
+    parser.add_argument('-o', '--output_dir',
+                        type=str, default='./benchmark',
+                        help='Folder for the generated bags, outputs and results')
+    parser.add_argument('-s', '--scenarios',
+                        nargs='+', choices=list(SCENARIOS), default=DEFAULT_SCENARIOS,
+                        help='Stages to run on their own, full runs the whole pipeline')
+    parser.add_argument('-rc', '--raw_cameras',
+                        type=int, default=2,
+                        help='Number of cameras with Image topics')
+    parser.add_argument('-cc', '--compressed_cameras',
+                        type=int, default=2,
+                        help='Number of cameras with CompressedImage topics')
+    parser.add_argument('-res', '--resolution',
+                        type=resolution, default=(1280, 720),
+                        help='Camera resolution as WIDTHxHEIGHT')
+    parser.add_argument('-fr', '--frame_rate',
+                        type=float, default=10,
+                        help='Camera frame rate')
+    parser.add_argument('-du', '--duration',
+                        type=float, default=10,
+                        help='Length of the bag in seconds')
+    parser.add_argument('-pp', '--points',
+                        type=int, default=100000,
+                        help='Points per pointcloud, 0 for no pointcloud topic')
+    parser.add_argument('-pr', '--pointcloud_rate',
+                        type=float, default=10,
+                        help='Pointcloud rate')
+    parser.add_argument('-mr', '--misc_rate',
+                        type=float, default=50,
+                        help='Rate of the gps and twist topics, 0 for none')
+    parser.add_argument('-st', '--storage',
+                        type=str, choices=['sqlite3', 'mcap'], default='sqlite3',
+                        help='Storage format of the generated bag')
+    parser.add_argument('-ew', '--export_workers',
+                        type=int,
+                        help='Number of image export processes')
+    parser.add_argument('-b', '--baseline',
+                        type=str,
+                        help='Results of an earlier run to compare against, exits with 1 on a regression')
+    parser.add_argument('-sb', '--save_baseline',
+                        type=str,
+                        help='Save the results as a baseline for later runs')
+    parser.add_argument('-t', '--tolerance',
+                        type=float, default=0.1,
+                        help='Allowed relative slowdown or memory growth against the baseline')
+    # runs a single scenario, used by the benchmark for each of them
+    parser.add_argument('--run', nargs=3, metavar=('BAG', 'OUTPUT', 'SCENARIO'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        json.dump(run_scenario(*args.run, args.export_workers), sys.stdout)
+        sys.exit()
+
+    bag = prepare_bag(args)
+    results = {}
+    for name in args.scenarios:
+        log_and_print(f'Running {name}')
+        cmd = [sys.executable, os.path.realpath(__file__), '--run', bag,
+               os.path.join(os.path.realpath(args.output_dir), 'runs', name), name]
+        if args.export_workers:
+            cmd += ['--export_workers', str(args.export_workers)]
+        # the parser prints its progress, the result is the last line
+        output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results[name] = json.loads(output.strip().splitlines()[-1])
+
+    print_results(results)
+    report = {'bag': bag_config(args), 'results': results}
+    with open(os.path.join(os.path.realpath(args.output_dir), 'results.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['bag'] != report['bag']:
+            print('Baseline was run on a different bag, results are not comparable')
+        if compare(results, baseline['results'], args.tolerance):
+            sys.exit(1)
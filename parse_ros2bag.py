@@ -1,31 +1,91 @@
 #!/usr/bin/env python3
 
-import rosbag2_py
+import numpy as np
+try:
+    # only needed for binary_compressed pcd files
+    import lzf
+except ImportError:
+    lzf = None
 
 import yaml
 import argparse
 
 import subprocess
+import asyncio
 import threading
+import queue
+import collections
+import concurrent.futures
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import importlib
+import inspect
 
-import torch
+import psutil
 
 import sys
 import os
 import shutil
 import zipfile
+import tarfile
+import io
+import zlib
+import struct
+import csv
+import hashlib
+import json
+import sqlite3
+import glob
+import time
+import math
+import re
+import operator
+import contextlib
 
 import logging
 
 
-def log_stream(stream, prefix, logger):
-    for line in iter(stream.readline, ''):
-        # Skip spinner/progress-style lines (heuristic)
-        if line.strip() == '' or line.endswith('\r') or len(line.strip()) < 3:
-            continue
-        logger.info(f"[{prefix}] {line.strip()}")
-    stream.close()
+class LazyModule:
+    # stands in for a module and imports it on first use, so runs and stages that don't need
+    # the heavy dependencies (or just -h) don't pay for loading them
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+rosbag2_py = LazyModule('rosbag2_py')
+rclpy_serialization = LazyModule('rclpy.serialization')
+rosidl_utilities = LazyModule('rosidl_runtime_py.utilities')
+rosidl_convert = LazyModule('rosidl_runtime_py.convert')
+mcap_reader = LazyModule('mcap.reader')
+mcap_records = LazyModule('mcap.records')
+mcap_stream_reader = LazyModule('mcap.stream_reader')
+mcap_data_stream = LazyModule('mcap.data_stream')
+cv2 = LazyModule('cv2')
+torch = LazyModule('torch')
+pa = LazyModule('pyarrow')
+pq = LazyModule('pyarrow.parquet')
+pa_csv = LazyModule('pyarrow.csv')
+
+
+async def log_stream(stream, tag, logger):
+    # reads the pipe in chunks and logs whole lines tagged with the process, so output of
+    # concurrent processes doesn't interleave
+    rest = b''
+    while chunk := await stream.read(65536):
+        *lines, rest = (rest + chunk).split(b'\n')
+        for line in lines:
+            # only the last part of progress lines rewritten with \r is kept, short spinner lines are skipped
+            line = line.rsplit(b'\r', 1)[-1].strip()
+            if len(line) >= 3:
+                logger.info('[%s] %s', tag, line.decode(errors='replace'))
+    if len(rest.strip()) >= 3:
+        logger.info('[%s] %s', tag, rest.rsplit(b'\r', 1)[-1].strip().decode(errors='replace'))
 
 
 def log_and_print(message, logger=None):
@@ -34,50 +94,2273 @@ def log_and_print(message, logger=None):
         logger.info(message)
 
 
-def run_logged_subprocess(cmd, cwd='.', logger=None):
-    if not logger:
-        subprocess.run(cmd, cwd=cwd)
+async def run_process(cmd, cwd='.', logger=None, stdin=None, timeout=None, check=True, on_start=None):
+    # output is logged if there is a logger, otherwise it goes to the terminal
+    pipe = subprocess.PIPE if logger else None
+    process = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdin=stdin, stdout=pipe, stderr=pipe)
+    if on_start:
+        on_start(process)
+    tag = f'{os.path.basename(cmd[0])}:{process.pid}'
+    streams = [log_stream(process.stdout, f'{tag} stdout', logger),
+               log_stream(process.stderr, f'{tag} stderr', logger)] if logger else []
+    try:
+        await asyncio.wait_for(asyncio.gather(process.wait(), *streams), timeout)
+    except asyncio.TimeoutError:
+        await kill_process(process)
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    except asyncio.CancelledError:
+        await kill_process(process)
+        raise
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return process.returncode
+
+
+async def kill_process(process):
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+    await process.wait()
+
+
+class ProcessGroup:
+    # child processes of one bag, run in a single event loop in a background thread that multiplexes
+    # all of their pipes. When one of them fails the others are cancelled and killed
+    loop = None
+    loop_lock = threading.Lock()
+
+    def __init__(self, timeout=None, logger=None):
+        self.timeout = timeout
+        self.logger = logger
+        self.tasks = set()
+
+    @classmethod
+    def event_loop(cls):
+        with cls.loop_lock:
+            if cls.loop is None:
+                cls.loop = asyncio.new_event_loop()
+                threading.Thread(target=cls.loop.run_forever, name='ProcessLoop', daemon=True).start()
+        return cls.loop
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(self.supervise(coroutine), self.event_loop())
+
+    async def supervise(self, coroutine):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            return await coroutine
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            for sibling in self.tasks - {task}:
+                sibling.cancel()
+            raise
+        finally:
+            self.tasks.discard(task)
+
+    def cancel(self):
+        # kills every running process of the group
+        def cancel_all():
+            for task in self.tasks:
+                task.cancel()
+        self.event_loop().call_soon_threadsafe(cancel_all)
+
+    def run(self, cmd, cwd='.'):
+        # waits for the process, fails if it fails, times out or is cancelled
+        try:
+            return self.submit(run_process(cmd, cwd, self.logger, timeout=self.timeout)).result()
+        except concurrent.futures.CancelledError:
+            raise RuntimeError(f'{os.path.basename(cmd[0])} was cancelled, another process failed')
+
+    def popen(self, cmd, cwd='.', stdin=None):
+        return LoggedProcess(self, cmd, cwd, stdin)
+
+
+class LoggedProcess:
+    # Popen-like handle of a process in a ProcessGroup, for callers that feed it from their own thread.
+    # Its stdin is a plain pipe written directly, not through the event loop
+    def __init__(self, group, cmd, cwd='.', stdin=None):
+        self.returncode = None
+        self.stdin = None
+        read_fd = None
+        if stdin == subprocess.PIPE:
+            read_fd, write_fd = os.pipe()
+            self.stdin = open(write_fd, 'wb')
+            stdin = read_fd
+        started = concurrent.futures.Future()
+        self.future = group.submit(run_process(cmd, cwd, group.logger, stdin, check=False,
+                                               on_start=started.set_result))
+        concurrent.futures.wait([started, self.future], return_when=concurrent.futures.FIRST_COMPLETED)
+        if read_fd is not None:
+            # the child has its own copy now
+            os.close(read_fd)
+        if not started.done():
+            # failed to start, raise its error
+            if self.stdin:
+                self.stdin.close()
+            self.future.result()
+        self.pid = started.result().pid
+
+    def kill(self):
+        self.future.cancel()
+
+    def wait(self):
+        try:
+            self.returncode = self.future.result()
+        except concurrent.futures.CancelledError:
+            self.returncode = -9
+        return self.returncode
+
+
+def run_logged_subprocess(cmd, cwd='.', logger=None, group=None):
+    return (group or ProcessGroup(logger=logger)).run(cmd, cwd)
+
+
+def Popen_logged_subprocess(cmd, cwd='.', logger=None, stdin=None, group=None):
+    return (group or ProcessGroup(logger=logger)).popen(cmd, cwd, stdin)
+
+
+def header_stamp(data):
+    # serialized messages start with a 4 byte CDR encapsulation header followed by std_msgs/Header,
+    # so the stamp can be read without deserializing the whole (possibly huge) message
+    sec, nanosec = struct.unpack_from('<iI' if data[1] == 1 else '>iI', data, 4)
+    return sec * 1000000000 + nanosec
+
+
+class BagReader:
+    # selection is a filtered BagIndex, only its messages are passed on
+    def __init__(self, bag, storage_id='sqlite3', logger=None, selection=None):
+        self.bag = bag
+        self.storage_id = storage_id
+        self.logger = logger
+        self.selection = selection
+
+    def read(self, sinks):
+        # sinks: {topic_name: [sink, ...]}, every message is routed to all sinks of its topic
+        reader = rosbag2_py.SequentialReader()
+        reader.open(rosbag2_py.StorageOptions(uri=self.bag, storage_id=self.storage_id),
+                    rosbag2_py.ConverterOptions('cdr', 'cdr'))
+        reader.set_filter(rosbag2_py.StorageFilter(topics=list(sinks)))
+
+        keep = None
+        if self.selection:
+            keep = {t: set(self.selection.topics[t]['timestamps'].tolist()) for t in sinks}
+            start = min((min(k) for k in keep.values() if k), default=None)
+            if start is not None:
+                reader.seek(start)
+
+        def messages():
+            while reader.has_next():
+                topic, data, timestamp = reader.read_next()
+                if keep is None or timestamp in keep[topic]:
+                    yield topic, data, timestamp
+
+        message_count = 0
+        for batch in batched(messages()):
+            write_batch(sinks, batch)
+            message_count += len(batch)
+
+        close_sinks(sinks)
+        log_and_print(f'Read {message_count} messages', self.logger)
+
+
+def batched(messages, count=1024, size=64 << 20):
+    # (topic, data, timestamp) in batches of at most count messages or about size bytes
+    batch = []
+    batch_size = 0
+    for message in messages:
+        batch.append(message)
+        batch_size += len(message[1])
+        if len(batch) >= count or batch_size >= size:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def write_batch(sinks, batch):
+    # hands every sink the messages of its topics in the batch, in reading order
+    sink_batches = {}
+    for message in batch:
+        for sink in sinks[message[0]]:
+            sink_batches.setdefault(id(sink), (sink, []))[1].append(message)
+    for sink, messages in sink_batches.values():
+        sink.write_batch(messages)
+
+
+def close_sinks(sinks):
+    for sink in {id(s): s for topic_sinks in sinks.values() for s in topic_sinks}.values():
+        sink.close()
+
+
+def open_db3(path):
+    # read only connection to a bag file, memory mapped so reads come straight from the page cache
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    db.execute('PRAGMA query_only = 1')
+    db.execute(f'PRAGMA mmap_size = {os.path.getsize(path)}')
+    db.execute(f'PRAGMA cache_size = -{64 * 1024}')
+    return db
+
+
+class SqliteBagReader:
+    # reads the messages of uncompressed sqlite3 bags straight from their .db3 files in batches,
+    # instead of one by one through rosbag2. Payloads are passed on as the bytes sqlite returns.
+    # selection is a filtered BagIndex, only the rows it kept are fetched
+    BATCH_SIZE = 1024
+
+    def __init__(self, bag, logger=None, selection=None):
+        self.bag = bag
+        self.logger = logger
+        self.selection = selection
+
+    def read(self, sinks):
+        # sinks: {topic_name: [sink, ...]}, every message is routed to all sinks of its topic
+        message_count = 0
+        for file_index, f in enumerate(bag_files(self.bag)):
+            db = open_db3(f)
+            topic_names = {topic_id: name for topic_id, name in db.execute('SELECT id, name FROM topics')
+                           if name in sinks}
+            if topic_names:
+                for rows in self.fetch(db, file_index, topic_names, sinks):
+                    write_batch(sinks, [(topic_names[topic_id], data, timestamp) for topic_id, timestamp, data in rows])
+                    message_count += len(rows)
+            db.close()
+
+        close_sinks(sinks)
+        log_and_print(f'Read {message_count} messages', self.logger)
+
+    def fetch(self, db, file_index, topic_names, sinks):
+        if not self.selection:
+            cursor = db.execute('SELECT topic_id, timestamp, data FROM messages '
+                                f'WHERE topic_id IN ({", ".join("?" * len(topic_names))}) ORDER BY timestamp',
+                                list(topic_names))
+            yield from iter(lambda: cursor.fetchmany(self.BATCH_SIZE), [])
+            return
+
+        # rows kept by the filters, looked up by id so the others are never read
+        topics = [self.selection.topics[t] for t in topic_names.values()]
+        ids = np.sort(np.concatenate([t['ids'][t['files'] == file_index] for t in topics]))
+        for i in range(0, len(ids), self.BATCH_SIZE):
+            yield db.execute('SELECT topic_id, timestamp, data FROM messages '
+                             'WHERE id IN (SELECT value FROM json_each(?)) ORDER BY timestamp',
+                             [json.dumps(ids[i:i + self.BATCH_SIZE].tolist())]).fetchall()
+
+
+def read_mcap_chunk(path, offset, channels, head_only=False):
+    # runs in an export worker process: decompresses one chunk of an mcap file and splits it into messages.
+    # channels maps the wanted channel ids to the log times to keep, or None to keep all
+    with open(path, 'rb') as f:
+        # skip the opcode and record length
+        f.seek(offset + 1 + 8)
+        chunk = mcap_records.Chunk.read(mcap_data_stream.ReadDataStream(f))
+    messages = [(record.log_time, record.channel_id, record.data[:12] if head_only else record.data)
+                for record in mcap_stream_reader.breakup_chunk(chunk)
+                if isinstance(record, mcap_records.Message) and record.channel_id in channels
+                and (channels[record.channel_id] is None or record.log_time in channels[record.channel_id])]
+    messages.sort(key=lambda m: m[0])
+    return messages
+
+
+def mcap_topics(path):
+    with open(path, 'rb') as f:
+        reader = mcap_reader.make_reader(f)
+        summary = reader.get_summary()
+        if summary is None:
+            return {channel.topic: schema.name if schema else '' for schema, channel, _ in reader.iter_messages()}
+    return {c.topic: summary.schemas[c.schema_id].name if c.schema_id else '' for c in summary.channels.values()}
+
+
+def mcap_messages(path, topics=None, pool=None, head_only=False, ahead=8, keep=None):
+    # (topic, log time, data) of the messages of an mcap file, read through its chunk index:
+    # chunks are decompressed in the pool's worker processes, a few of them ahead of the caller.
+    # keep optionally maps topics to the sorted log times of the messages to keep
+    with open(path, 'rb') as f:
+        reader = mcap_reader.make_reader(f)
+        summary = reader.get_summary()
+        if summary is None or not summary.chunk_indexes:
+            # no index, read it front to back
+            for _, channel, message in reader.iter_messages(topics):
+                if keep is None or message.log_time in keep[channel.topic]:
+                    yield channel.topic, message.log_time, message.data[:12] if head_only else message.data
+            return
 
-    else:
-        process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    channels = {i: c.topic for i, c in summary.channels.items() if topics is None or c.topic in topics}
+    # chunks without any of the topics are skipped, if the file has message indices to tell
+    chunks = [c for c in sorted(summary.chunk_indexes, key=lambda c: c.message_start_time)
+              if not c.message_index_offsets or channels.keys() & c.message_index_offsets.keys()]
+
+    def chunk_channels(chunk):
+        if keep is None:
+            return dict.fromkeys(channels)
+        # log times kept within the chunk, chunks without any are skipped
+        kept = {}
+        for channel_id, topic in channels.items():
+            times = keep[topic]
+            times = times[np.searchsorted(times, chunk.message_start_time):
+                          np.searchsorted(times, chunk.message_end_time, 'right')]
+            if len(times):
+                kept[channel_id] = set(times.tolist())
+        return kept
+
+    chunks = [(c, chunk_channels(c)) for c in chunks]
+    chunks = [(c, kept) for c, kept in chunks if kept]
+
+    pending = collections.deque()
+    for i, (chunk, kept) in enumerate(chunks):
+        args = (path, chunk.chunk_start_offset, kept, head_only)
+        pending.append(pool.submit(read_mcap_chunk, *args) if pool else args)
+        while pending and (len(pending) > ahead or i == len(chunks) - 1 or not pool):
+            item = pending.popleft()
+            for log_time, channel_id, data in item.result() if pool else read_mcap_chunk(*item):
+                yield channels[channel_id], log_time, data
+
+
+class McapBagReader:
+    # reads mcap bags natively, spreading the decompression of their chunks over the export processes.
+    # selection is a filtered BagIndex, only its messages are passed on
+    def __init__(self, bag, pool=None, logger=None, selection=None):
+        self.bag = bag
+        self.pool = pool
+        self.logger = logger
+        self.selection = selection
+
+    def read(self, sinks):
+        # sinks: {topic_name: [sink, ...]}, every message is routed to all sinks of its topic
+        message_count = 0
+        for file_index, f in enumerate(bag_files(self.bag)):
+            keep = None
+            if self.selection:
+                keep = {t: np.sort(self.selection.topics[t]['timestamps'][self.selection.topics[t]['files'] == file_index])
+                        for t in sinks}
+            messages = ((topic, data, timestamp)
+                        for topic, timestamp, data in mcap_messages(f, set(sinks), self.pool, keep=keep))
+            for batch in batched(messages):
+                write_batch(sinks, batch)
+                message_count += len(batch)
+
+        close_sinks(sinks)
+        log_and_print(f'Read {message_count} messages', self.logger)
+
+
+def bag_reader(bag, pool=None, logger=None, selection=None):
+    # bags rosbag2 has to decompress are left to it, sqlite3 and mcap bags are read straight from their files
+    info = bag_metadata(bag)
+    storage = bag_storage(bag)
+    if info.get('compression_format') or storage not in ('sqlite3', 'mcap') or not bag_files(bag):
+        return BagReader(bag, storage, logger, selection)
+    if storage == 'mcap':
+        return McapBagReader(bag, pool, logger, selection)
+    return SqliteBagReader(bag, logger, selection)
+
+
+# sensor_msgs/Image encoding -> (dtype, channels, name of the opencv conversion to bgr order).
+# Names, so opencv is only imported once images are converted
+IMAGE_ENCODINGS = {
+        'mono8': (np.uint8, 1, None),
+        'mono16': (np.uint16, 1, None),
+        '8UC1': (np.uint8, 1, None),
+        '8UC3': (np.uint8, 3, None),
+        '8UC4': (np.uint8, 4, None),
+        '16UC1': (np.uint16, 1, None),
+        'bgr8': (np.uint8, 3, None),
+        'bgra8': (np.uint8, 4, None),
+        'bgr16': (np.uint16, 3, None),
+        'bgra16': (np.uint16, 4, None),
+        'rgb8': (np.uint8, 3, 'COLOR_RGB2BGR'),
+        'rgba8': (np.uint8, 4, 'COLOR_RGBA2BGRA'),
+        'rgb16': (np.uint16, 3, 'COLOR_RGB2BGR'),
+        'rgba16': (np.uint16, 4, 'COLOR_RGBA2BGRA'),
+        'bayer_rggb8': (np.uint8, 1, 'COLOR_BayerBG2BGR'),
+        'bayer_bggr8': (np.uint8, 1, 'COLOR_BayerRG2BGR'),
+        'bayer_gbrg8': (np.uint8, 1, 'COLOR_BayerGR2BGR'),
+        'bayer_grbg8': (np.uint8, 1, 'COLOR_BayerGB2BGR'),
+        }
+
+
+def image_msg_to_array(msg):
+    dtype, channels, conversion = IMAGE_ENCODINGS[msg.encoding]
+    dtype = np.dtype(dtype).newbyteorder('>' if msg.is_bigendian else '<')
+
+    # rows may be padded to msg.step bytes
+    rows = np.frombuffer(msg.data, dtype=np.uint8).reshape(msg.height, msg.step)
+    image = rows[:, :msg.width * channels * dtype.itemsize].view(dtype).reshape(msg.height, msg.width, channels)
+    image = image.astype(dtype.newbyteorder('='), copy=False)
+    if channels == 1:
+        image = image[:, :, 0]
+
+    if conversion is not None:
+        image = cv2.cvtColor(np.ascontiguousarray(image), getattr(cv2, conversion))
+    return image
+
+
+def encode_image(msg_type, data):
+    # runs in an image export worker process
+    msg = rclpy_serialization.deserialize_message(data, rosidl_utilities.get_message(msg_type))
+    stamp = msg.header.stamp.sec * 1000000000 + msg.header.stamp.nanosec
+
+    if msg_type == 'sensor_msgs/msg/CompressedImage':
+        # already encoded, keep as is
+        return stamp, 'png' if 'png' in msg.format else 'jpg', bytes(msg.data)
+    return stamp, 'png', cv2.imencode('.png', image_msg_to_array(msg))[1].tobytes()
+
+
+def export_image(msg_type, data, out_path):
+    # runs in an image export worker process
+    stamp, extension, encoded = encode_image(msg_type, data)
+
+    # write under a temporary name first, so a finished frame is never a partial file
+    path = os.path.join(out_path, f'{stamp}.{extension}')
+    with open(os.path.join(out_path, f'{stamp}.part.{extension}'), 'wb') as f:
+        f.write(encoded)
+    os.replace(os.path.join(out_path, f'{stamp}.part.{extension}'), path)
+    return stamp, path, None
+
+
+def encode_frame(msg_type, data, out_path):
+    # runs in an image export worker process, the frame goes back encoded instead of being written
+    stamp, extension, encoded = encode_image(msg_type, data)
+    return stamp, os.path.join(out_path, f'{stamp}.{extension}'), encoded
+
+
+class ImageExportPool:
+    def __init__(self, workers=None, governor=None):
+        workers = workers or os.cpu_count()
+        # workers are started on demand, when the reading, blurring and process group threads are running.
+        # Forking a threaded process can leave locks held in the child, start them from a clean process instead
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+        self.governor = governor
+        # limit the number of queued messages so reading can't run away from encoding
+        self.slots = threading.BoundedSemaphore(workers * 4)
+        # submitted on the reading thread, done on the executor's, so counted under a lock
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def submit(self, function, *args):
+        if self.governor:
+            self.governor.wait_for_memory(lambda: self.in_flight > 0)
+        self.slots.acquire()
+        with self.lock:
+            self.in_flight += 1
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(self.exported)
+        return future
+
+    def exported(self, future):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class Exporter:
+    # receives the messages of the topics it was created for while the bag is read, a batch at a time
+    # in reading order. Subclasses handle single messages in write, or whole batches in write_batch;
+    # messages of one they don't handle are dropped
+    def write(self, topic, data, timestamp):
+        pass
+
+    def write_batch(self, messages):
+        for topic, data, timestamp in messages:
+            self.write(topic, data, timestamp)
+
+    def close(self):
+        pass
+
+
+class ImageSink(Exporter):
+    # with direct set frames are not written, on_frame gets them encoded along with the path they would have
+    def __init__(self, msg_type, out_path, pool, on_frame=None, done=None, direct=False):
+        self.msg_type = msg_type
+        self.out_path = out_path
+        self.pool = pool
+        self.on_frame = on_frame
+        self.done = done
+        self.export = encode_frame if direct else export_image
+        self.pending = collections.deque()
+        if not direct:
+            os.makedirs(out_path, exist_ok=True)
+
+    def write(self, topic, data, timestamp):
+        # skip frames finished by a previous run
+        if self.done and self.done(topic, header_stamp(data)):
+            return
+
+        self.pending.append((topic, self.pool.submit(self.export, self.msg_type, data, self.out_path)))
+
+        # hand on the frames that are already written, in order
+        while self.pending and self.pending[0][1].done():
+            self.frame_exported(*self.pending.popleft())
 
-        # Start threads to capture stdout and stderr
-        threading.Thread(target=log_stream, args=(process.stdout, "stdout", logger), daemon=True).start()
-        threading.Thread(target=log_stream, args=(process.stderr, "stderr", logger), daemon=True).start()
+    def frame_exported(self, topic, future):
+        # raises the worker's error if there was any
+        stamp, path, encoded = future.result()
+        if self.on_frame:
+            self.on_frame(topic, stamp, path, encoded)
 
-        process.wait()
+    def close(self):
+        while self.pending:
+            self.frame_exported(*self.pending.popleft())
 
 
-def Popen_logged_subprocess(cmd, cwd='.', logger=None):
-    if not logger:
-        return subprocess.Popen(cmd, cwd=cwd)
+# PointField datatype -> numpy type
+POINTFIELD_TYPES = {1: 'i1', 2: 'u1', 3: 'i2', 4: 'u2', 5: 'i4', 6: 'u4', 7: 'f4', 8: 'f8'}
 
+
+def pointcloud_array(msg):
+    # view the point buffer through a structured dtype built from the fields once, no per point conversion
+    endian = '>' if msg.is_bigendian else '<'
+    fields = [f for f in msg.fields if f.datatype in POINTFIELD_TYPES]
+    formats = [(endian + POINTFIELD_TYPES[f.datatype], (f.count,)) if f.count > 1 else endian + POINTFIELD_TYPES[f.datatype]
+               for f in fields]
+    dtype = np.dtype({'names': [f.name for f in fields], 'formats': formats,
+                      'offsets': [f.offset for f in fields], 'itemsize': msg.point_step})
+
+    # rows may be padded to msg.row_step bytes
+    if msg.row_step == msg.width * msg.point_step:
+        points = np.frombuffer(msg.data, dtype=dtype, count=msg.width * msg.height)
     else:
-        process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        rows = np.frombuffer(msg.data, dtype=np.uint8).reshape(msg.height, msg.row_step)
+        points = np.ascontiguousarray(rows[:, :msg.width * msg.point_step]).view(dtype).reshape(-1)
+
+    # packed, native byte order copy without the padding between fields
+    packed = np.empty(len(points), dtype=[(name, dtype.fields[name][0].newbyteorder('=')) for name in dtype.names])
+    for name in dtype.names:
+        packed[name] = points[name]
+    return packed
+
+
+def pcd_header(points, width, height, data_format):
+    types = [points.dtype.fields[name][0] for name in points.dtype.names]
+    return ('VERSION .7\n'
+            f'FIELDS {" ".join(points.dtype.names)}\n'
+            f'SIZE {" ".join(str(t.base.itemsize) for t in types)}\n'
+            f'TYPE {" ".join(t.base.kind.upper() for t in types)}\n'
+            f'COUNT {" ".join(str(int(np.prod(t.shape))) for t in types)}\n'
+            f'WIDTH {width}\n'
+            f'HEIGHT {height}\n'
+            'VIEWPOINT 0 0 0 1 0 0 0\n'
+            f'POINTS {len(points)}\n'
+            f'DATA {data_format}\n').encode()
+
+
+def export_pointcloud(msg_type, data, path, data_format='binary'):
+    # runs in an export worker process
+    msg = rclpy_serialization.deserialize_message(data, rosidl_utilities.get_message(msg_type))
+    points = pointcloud_array(msg)
+
+    # write under a temporary name first, so a finished file is never a partial one
+    part_path = path + '.part'
+    with open(part_path, 'wb') as f:
+        if data_format == 'npy':
+            np.save(f, points)
+        elif data_format == 'npz':
+            np.savez_compressed(f, **{name: points[name] for name in points.dtype.names})
+        elif data_format == 'binary':
+            f.write(pcd_header(points, msg.width, msg.height, 'binary'))
+            f.write(points.data)
+        elif data_format == 'binary_compressed':
+            # fields one after the other instead of interleaved, then lzf compressed
+            fields = b''.join(np.ascontiguousarray(points[name]).tobytes() for name in points.dtype.names)
+            compressed = lzf.compress(fields, len(fields) + len(fields) // 16 + 64) if fields else b''
+            f.write(pcd_header(points, msg.width, msg.height, 'binary_compressed'))
+            f.write(struct.pack('<II', len(compressed), len(fields)))
+            f.write(compressed)
+        else:
+            f.write(pcd_header(points, msg.width, msg.height, 'ascii'))
+            columns, formats = [], []
+            for name in points.dtype.names:
+                column = points[name].reshape(len(points), -1)
+                columns += list(column.T)
+                formats += ['%.8g' if column.dtype.kind == 'f' else '%d'] * column.shape[1]
+            if columns:
+                np.savetxt(f, np.column_stack(columns), fmt=formats)
+    os.replace(part_path, path)
+
+
+class PointcloudSink(Exporter):
+    EXTENSIONS = {'ascii': 'pcd', 'binary': 'pcd', 'binary_compressed': 'pcd', 'npy': 'npy', 'npz': 'npz'}
+
+    def __init__(self, msg_type, out_path, pool, data_format=None, resume=False):
+        self.msg_type = msg_type
+        self.out_path = out_path
+        self.pool = pool
+        self.data_format = data_format or 'binary'
+        self.extension = self.EXTENSIONS[self.data_format]
+        if self.data_format == 'binary_compressed' and lzf is None:
+            raise RuntimeError('binary_compressed pointclouds need the lzf module (pip install python-lzf)')
+        self.resume = resume
+        self.pending = collections.deque()
+        self.count = 0
+        os.makedirs(out_path, exist_ok=True)
+
+    def write(self, topic, data, timestamp):
+        path = os.path.join(self.out_path, f'{header_stamp(data)}.{self.extension}')
+        if self.resume and os.path.isfile(path):
+            return
+        self.count += 1
+
+        self.pending.append(self.pool.submit(export_pointcloud, self.msg_type, data, path, self.data_format))
+        # raise the errors of finished exports early
+        while self.pending and self.pending[0].done():
+            self.pending.popleft().result()
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+
+# ROS primitive type -> arrow type
+# names of the pyarrow type functions, called when pyarrow is loaded
+ARROW_TYPES = {
+        'boolean': 'bool_', 'octet': 'uint8', 'char': 'string',
+        'int8': 'int8', 'uint8': 'uint8', 'int16': 'int16', 'uint16': 'uint16',
+        'int32': 'int32', 'uint32': 'uint32', 'int64': 'int64', 'uint64': 'uint64',
+        'float': 'float32', 'double': 'float64', 'long double': 'float64',
+        'string': 'string', 'wstring': 'string',
+        }
+
+
+def tolist(value):
+    # fixed size arrays are numpy arrays, sequences array.arrays or lists
+    return value.tolist() if hasattr(value, 'tolist') else list(value)
+
+
+def message_columns(msg_class, prefix=''):
+    # (name, getter, arrow type, converter) of every leaf field of a message type, nested messages are
+    # flattened into dotted names. Worked out once per type, rows are then read with attrgetters
+    columns = []
+    for name, field_type in msg_class.get_fields_and_field_types().items():
+        match = re.fullmatch(r'sequence<(.+?)(?:, \d+)?>|(.+?)\[\d+\]', field_type)
+        array = match is not None
+        # bounded strings are string<=N
+        base = re.sub(r'<=\d+>?$', '', (match.group(1) or match.group(2)) if array else field_type)
+
+        if '/' in base and not array:
+            package, type_name = base.split('/')[0], base.split('/')[-1]
+            columns += message_columns(rosidl_utilities.get_message(f'{package}/msg/{type_name}'), f'{prefix}{name}.')
+        elif '/' in base:
+            # arrays of messages are kept as text
+            columns.append((prefix + name, operator.attrgetter(prefix + name), pa.string(),
+                            lambda v: str([rosidl_convert.message_to_ordereddict(m) for m in v])))
+        elif array:
+            columns.append((prefix + name, operator.attrgetter(prefix + name), pa.list_(getattr(pa, ARROW_TYPES[base])()), tolist))
+        else:
+            columns.append((prefix + name, operator.attrgetter(prefix + name), getattr(pa, ARROW_TYPES[base])(), None))
+    return columns
+
+
+def write_kml(path, name, longitudes, latitudes, altitudes):
+    coordinates = '\n'.join(f'{lon:.8f},{lat:.8f},{alt:.3f}' for lon, lat, alt in zip(longitudes, latitudes, altitudes))
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+                f'<Document><name>{name}</name>\n'
+                f'<Placemark><name>{name}</name><LineString><altitudeMode>absolute</altitudeMode><coordinates>\n'
+                f'{coordinates}\n'
+                '</coordinates></LineString></Placemark>\n'
+                '</Document></kml>\n')
+
+
+class MiscSink(Exporter):
+    # typed columns of a message type, written as Parquet and/or CSV in record batches
+    BATCH_SIZE = 65536
+    # messages that are lists of records are written one row per record
+    EXPLODE = {'tf2_msgs/msg/TFMessage': ('transforms', 'geometry_msgs/msg/TransformStamped')}
+
+    def __init__(self, msg_type, out_path, formats=None):
+        self.msg_class = rosidl_utilities.get_message(msg_type)
+        self.msg_type = msg_type
+        self.out_path = out_path
+        self.formats = formats or ['parquet']
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        row_type = self.EXPLODE.get(msg_type, (None, msg_type))[1]
+        self.columns = [('timestamp', None, pa.int64(), None)] + message_columns(rosidl_utilities.get_message(row_type))
+        self.schema = pa.schema([(name, arrow_type) for name, _, arrow_type, _ in self.columns])
+        # csv has no lists, they are written as text like before
+        self.csv_schema = pa.schema([(name, pa.string() if pa.types.is_list(arrow_type) else arrow_type)
+                                     for name, _, arrow_type, _ in self.columns])
+        self.buffers = [[] for _ in self.columns]
+        self.parquet_writer = pq.ParquetWriter(out_path + '.parquet', self.schema, compression='zstd') \
+            if 'parquet' in self.formats else None
+        self.csv_writer = pa_csv.CSVWriter(out_path + '.csv', self.csv_schema) if 'csv' in self.formats else None
+
+        # gps tracks are also written as kml
+        self.track = [] if msg_type == 'sensor_msgs/msg/NavSatFix' else None
+        self.count = 0
+
+    def write(self, topic, data, timestamp):
+        self.count += 1
+        msg = rclpy_serialization.deserialize_message(data, self.msg_class)
+        rows = getattr(msg, self.EXPLODE[self.msg_type][0]) if self.msg_type in self.EXPLODE else [msg]
+        for row in rows:
+            self.buffers[0].append(timestamp)
+            for buffer, (_, getter, _, converter) in zip(self.buffers[1:], self.columns[1:]):
+                value = getter(row)
+                buffer.append(converter(value) if converter else value)
+            if self.track is not None and row.status.status >= 0:
+                self.track.append((row.longitude, row.latitude, row.altitude))
+        if len(self.buffers[0]) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffers[0]:
+            return
+        arrays = [pa.array(buffer, type=arrow_type) for buffer, (_, _, arrow_type, _) in zip(self.buffers, self.columns)]
+        if self.parquet_writer:
+            self.parquet_writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        if self.csv_writer:
+            arrays = [pa.array([str(v) for v in buffer]) if pa.types.is_list(arrow_type) else array
+                      for array, buffer, (_, _, arrow_type, _) in zip(arrays, self.buffers, self.columns)]
+            self.csv_writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.csv_schema))
+        self.buffers = [[] for _ in self.columns]
+
+    def close(self):
+        self.flush()
+        if self.parquet_writer:
+            self.parquet_writer.close()
+        if self.csv_writer:
+            self.csv_writer.close()
+        if self.track:
+            track = np.array(self.track)
+            track = track[np.isfinite(track).all(axis=1)]
+            write_kml(self.out_path + '.kml', os.path.basename(self.out_path), *track.T)
+
+
+def match_stamps(stamps, slop):
+    # approximate time matching of sorted stamp arrays {topic: array}: pivot on the topic with the
+    # fewest messages, take the closest message of every other topic, keep sets that fit into the slop
+    topics = list(stamps)
+    pivot = stamps[min(topics, key=lambda t: len(stamps[t]))]
+    if any(len(stamps[t]) == 0 for t in topics):
+        return np.empty((0, len(topics)), dtype=np.int64)
+
+    indices = []
+    for t in topics:
+        after = np.clip(np.searchsorted(stamps[t], pivot), 0, len(stamps[t]) - 1)
+        before = np.clip(after - 1, 0, None)
+        closer_before = np.abs(stamps[t][before] - pivot) <= np.abs(stamps[t][after] - pivot)
+        indices.append(np.where(closer_before, before, after))
+    indices = np.stack(indices, axis=1)
+
+    matched = np.stack([stamps[t][indices[:, i]] for i, t in enumerate(topics)], axis=1)
+    valid = matched.max(axis=1) - matched.min(axis=1) <= slop
+
+    # every message can only be used once: indices are non-decreasing along the pivot, so a set
+    # can only reuse a message of the last kept set. Keep the first of them in one greedy pass
+    indices, matched = indices[valid], matched[valid]
+    kept, last = [], None
+    for i, row in enumerate(indices.tolist()):
+        if last is None or all(a != b for a, b in zip(row, last)):
+            kept.append(i)
+            last = row
+
+    return matched[kept]
+
+
+def bag_metadata(bag):
+    metadata_path = os.path.join(bag, 'metadata.yaml')
+    if not os.path.isfile(metadata_path):
+        return {}
+    with open(metadata_path) as f:
+        return (yaml.safe_load(f) or {}).get('rosbag2_bagfile_information', {})
+
+
+def bag_files(bag):
+    # data files of a bag folder in recording order, split bags have several
+    if not os.path.isdir(bag):
+        return [bag]
+    files = bag_metadata(bag).get('relative_file_paths')
+    if files:
+        return [os.path.join(bag, f) for f in files]
+    files = glob.glob(os.path.join(bag, '*.db3')) + glob.glob(os.path.join(bag, '*.mcap'))
+    # bag_2 comes before bag_10
+    return sorted(files, key=lambda f: [int(p) if p.isdigit() else p for p in re.split(r'(\d+)', f)])
+
+
+def bag_storage(bag):
+    files = bag_files(bag)
+    return bag_metadata(bag).get('storage_identifier') or \
+        ('mcap' if files and files[0].endswith('.mcap') else 'sqlite3')
+
+
+def bag_summary(bag, samples=16):
+    # topic name -> type, message count and average message size, and the duration of the bag in seconds.
+    # Only the metadata and the first few messages of every topic are read, not the whole bag.
+    # Files of compressed bags can't be opened directly, their sizes are unknown (None)
+    topics = {}
+    metadata = bag_metadata(bag)
+    for t in metadata.get('topics_with_message_count', []):
+        topics[t['topic_metadata']['name']] = {'type': t['topic_metadata']['type'], 'count': t['message_count'], 'sizes': []}
+    duration = metadata.get('duration', {}).get('nanoseconds', 0) / 1e9
+    counted = bool(topics)
+    if metadata.get('compression_format'):
+        return {name: {'type': t['type'], 'count': t['count'], 'size': None} for name, t in topics.items()}, duration
+
+    for path in bag_files(bag):
+        if path.endswith('.mcap'):
+            with open(path, 'rb') as f:
+                reader = mcap_reader.make_reader(f)
+                summary = reader.get_summary()
+                statistics = summary.statistics if summary else None
+                for name, msg_type in mcap_topics(path).items():
+                    topics.setdefault(name, {'type': msg_type, 'count': 0, 'sizes': []})
+                if statistics and not counted:
+                    for channel_id, count in statistics.channel_message_counts.items():
+                        topics[summary.channels[channel_id].topic]['count'] += count
+                    duration += (statistics.message_end_time - statistics.message_start_time) / 1e9
+                wanted = [name for name, t in topics.items() if len(t['sizes']) < samples]
+                if wanted:
+                    for _, channel, message in reader.iter_messages(topics=wanted):
+                        sizes = topics[channel.topic]['sizes']
+                        if len(sizes) < samples:
+                            sizes.append(len(message.data))
+                            wanted = [name for name in wanted if name != channel.topic or len(sizes) < samples]
+                            if not wanted:
+                                break
+        else:
+            db = open_db3(path)
+            topic_ids = {}
+            for topic_id, name, msg_type in db.execute('SELECT id, name, type FROM topics'):
+                topic_ids[topic_id] = name
+                topics.setdefault(name, {'type': msg_type, 'count': 0, 'sizes': []})
+            if not counted:
+                for topic_id, count in db.execute('SELECT topic_id, count(*) FROM messages GROUP BY topic_id'):
+                    topics[topic_ids[topic_id]]['count'] += count
+            for topic_id, name in topic_ids.items():
+                sizes = topics[name]['sizes']
+                if len(sizes) < samples:
+                    sizes += [size for size, in db.execute('SELECT length(data) FROM messages WHERE topic_id = ? LIMIT ?',
+                                                           (topic_id, samples - len(sizes)))]
+            if not duration:
+                first, last = db.execute('SELECT min(timestamp), max(timestamp) FROM messages').fetchone()
+                duration += (last - first) / 1e9 if first is not None else 0
+            db.close()
+
+    return {name: {'type': t['type'], 'count': t['count'], 'size': sum(t['sizes']) / len(t['sizes']) if t['sizes'] else 0}
+            for name, t in topics.items()}, duration
+
+
+def parse_header_stamps(heads):
+    # header stamps in ns from the first 12 bytes of cdr messages. They are only meaningful
+    # for messages starting with a std_msgs/Header
+    heads = np.frombuffer(b''.join(heads), dtype=np.uint8).reshape(-1, 12)
+    little_endian = heads[:, 1] == 1
+    sec = np.where(little_endian, heads[:, 4:8].copy().view('<i4')[:, 0], heads[:, 4:8].copy().view('>i4')[:, 0])
+    nanosec = np.where(little_endian, heads[:, 8:12].copy().view('<u4')[:, 0], heads[:, 8:12].copy().view('>u4')[:, 0])
+    return sec.astype(np.int64) * 1000000000 + nanosec
+
+
+class StampSink(Exporter):
+    # collects the header stamps of a topic while the bag is read, for the bag index
+    def __init__(self):
+        self.timestamps = []
+        self.heads = []
+
+    def write_batch(self, messages):
+        for _, data, timestamp in messages:
+            self.timestamps.append(timestamp)
+            self.heads.append(bytes(data[:12]).ljust(12, b'\0'))
+
+
+class BagIndex:
+    # sidecar file of every message's row id and receive timestamp per topic, so later runs over the same bag
+    # don't have to scan it again. Building it only reads the message tables and chunk indices, not the
+    # payloads: header stamps are added as the read pass sees the messages, see stamp_sinks
+    VERSION = 2
+    FIELDS = ('files', 'ids', 'timestamps', 'stamps')
+
+    def __init__(self, bag, index_dir=None, logger=None, pool=None):
+        self.bag = bag
+        self.files = bag_files(bag)
+        self.logger = logger
+        self.pool = pool
+        self.topics = {} # name -> type, file indices, row ids, receive timestamps, header stamps (None until read)
+        self.filtered = False
+
+        # the index is only valid for the exact same bag files
+        self.key = [[f, os.path.getsize(f), os.stat(f).st_mtime_ns] for f in self.files]
+        index_dir = os.path.expanduser(index_dir or '~/.cache/parse_ros2bag/index')
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, hashlib.sha1(bag.encode()).hexdigest() + '.npz')
+
+        if not self.load():
+            log_and_print('Indexing bag', self.logger)
+            self.build()
+            self.save()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        with np.load(self.path) as index:
+            meta = json.loads(str(index['meta']))
+            if meta['version'] != self.VERSION or meta['key'] != self.key:
+                return False
+            for i, (name, msg_type, stamped) in enumerate(meta['topics']):
+                self.topics[name] = {'type': msg_type, **{f: index[f'{i}_{f}'] for f in self.FIELDS}}
+                if not stamped:
+                    self.topics[name]['stamps'] = None
+        log_and_print(f'Loaded bag index from {self.path}', self.logger)
+        return True
+
+    def save(self):
+        # a filtered index only holds part of the bag
+        if self.filtered:
+            return
+        meta = {'version': self.VERSION, 'key': self.key,
+                'topics': [[name, t['type'], t['stamps'] is not None] for name, t in self.topics.items()]}
+        arrays = {f'{i}_{f}': t[f] if t[f] is not None else np.zeros(0, dtype=np.int64)
+                  for i, t in enumerate(self.topics.values()) for f in self.FIELDS}
+        np.savez(self.path + '.part.npz', meta=json.dumps(meta), **arrays)
+        os.replace(self.path + '.part.npz', self.path)
+
+    def build(self):
+        rows = {}
+        if bag_metadata(self.bag).get('compression_format'):
+            # only rosbag2 can decompress these, their header stamps come with the timestamps
+            self.read_rosbag2(rows)
+        else:
+            for file_index, f in enumerate(self.files):
+                if f.endswith('.mcap'):
+                    self.read_mcap(file_index, f, rows)
+                else:
+                    self.read_db3(file_index, f, rows)
+
+        for name, topic in rows.items():
+            # chunks of split and mcap files may overlap in time
+            topic['rows'].sort(key=lambda row: row[2])
+            files, ids, timestamps, heads = zip(*topic['rows']) if topic['rows'] else ((), (), (), ())
+            self.topics[name] = {
+                    'type': topic['type'],
+                    'files': np.array(files, dtype=np.int32),
+                    'ids': np.array(ids, dtype=np.int64),
+                    'timestamps': np.array(timestamps, dtype=np.int64),
+                    'stamps': parse_header_stamps(heads) if topic['stamped'] else None,
+                    }
+
+    def read_db3(self, file_index, path, rows):
+        db = open_db3(path)
+        topic_names = {}
+        for topic_id, name, msg_type in db.execute('SELECT id, name, type FROM topics'):
+            topic_names[topic_id] = name
+            rows.setdefault(name, {'type': msg_type, 'rows': [], 'stamped': False})
+
+        # the payloads are left alone, even substr() would load them
+        for row_id, topic_id, timestamp in db.execute('SELECT id, topic_id, timestamp FROM messages ORDER BY timestamp'):
+            rows[topic_names[topic_id]]['rows'].append((file_index, row_id, timestamp, None))
+        db.close()
+
+    def read_mcap(self, file_index, path, rows):
+        with open(path, 'rb') as f:
+            summary = mcap_reader.make_reader(f).get_summary()
+            if summary is None or not summary.chunk_indexes or \
+                    not all(c.message_index_offsets for c in summary.chunk_indexes):
+                # without message indices the chunks have to be read, the stamps come with them
+                for name, msg_type in mcap_topics(path).items():
+                    rows.setdefault(name, {'type': msg_type, 'rows': [], 'stamped': True})
+                for i, (name, timestamp, head) in enumerate(mcap_messages(path, pool=self.pool, head_only=True)):
+                    rows[name]['rows'].append((file_index, i, timestamp, bytes(head).ljust(12, b'\0')))
+                return
+
+            for c in summary.channels.values():
+                schema = summary.schemas.get(c.schema_id)
+                rows.setdefault(c.topic, {'type': schema.name if schema else '', 'rows': [], 'stamped': False})
+            # the message index records after every chunk list the log times of its messages per channel
+            log_times = []
+            for chunk in summary.chunk_indexes:
+                for channel_id, offset in chunk.message_index_offsets.items():
+                    # skip the opcode and record length
+                    f.seek(offset + 1 + 8)
+                    message_index = mcap_records.MessageIndex.read(mcap_data_stream.ReadDataStream(f))
+                    log_times += [(log_time, summary.channels[channel_id].topic)
+                                  for log_time, _ in message_index.records]
+        # mcap messages have no row ids, number them in reading order
+        log_times.sort(key=lambda m: m[0])
+        for i, (timestamp, name) in enumerate(log_times):
+            rows[name]['rows'].append((file_index, i, timestamp, None))
+
+    def read_rosbag2(self, rows):
+        reader = rosbag2_py.SequentialReader()
+        reader.open(rosbag2_py.StorageOptions(uri=self.bag, storage_id=bag_storage(self.bag)),
+                    rosbag2_py.ConverterOptions('cdr', 'cdr'))
+        for t in reader.get_all_topics_and_types():
+            rows.setdefault(t.name, {'type': t.type, 'rows': [], 'stamped': True})
+        i = 0
+        while reader.has_next():
+            name, data, timestamp = reader.read_next()
+            rows[name]['rows'].append((0, i, timestamp, bytes(data[:12]).ljust(12, b'\0')))
+            i += 1
+
+    def stamp_sinks(self, topics):
+        # sinks recording the header stamps of the topics that don't have them yet
+        return {t: StampSink() for t in topics if t in self.topics and self.topics[t]['stamps'] is None}
+
+    def add_stamps(self, stamp_sinks):
+        # the sinks saw the messages of the index, sorted by receive time they line up with its rows
+        complete = True
+        for topic, sink in stamp_sinks.items():
+            t = self.topics[topic]
+            order = np.argsort(np.array(sink.timestamps, dtype=np.int64), kind='stable')
+            t['stamps'] = parse_header_stamps(sink.heads)[order]
+            if len(t['stamps']) != len(t['ids']):
+                log_and_print(f'Read {len(t["stamps"])} messages of {topic} instead of {len(t["ids"])}, '
+                              'not storing its stamps in the index', self.logger)
+                complete = False
+        if stamp_sinks and complete:
+            self.save()
+
+    def message_count(self, topic):
+        return len(self.topics[topic]['ids'])
+
+    def has_stamps(self, topics):
+        return all(self.topics[t]['stamps'] is not None for t in topics if t in self.topics)
+
+    def header_stamps(self, topic):
+        if self.topics[topic]['stamps'] is None:
+            raise RuntimeError(f'Header stamps of {topic} are not known before the bag is read')
+        return np.sort(self.topics[topic]['stamps'])
+
+    def apply_filters(self, start=None, end=None, decimation=None, max_rate=None, topic_rates=None, max_messages=None):
+        # drop the messages the filters skip from the index, in memory only. Readers given the
+        # filtered index only read what's left, and syncing and previews only see those messages.
+        # start and end are seconds from the start of the bag, max_rate and topic_rates in Hz
+        if start is None and end is None and not decimation and not max_rate and not topic_rates and not max_messages:
+            return
+        bag_start = min((t['timestamps'].min() for t in self.topics.values() if len(t['timestamps'])), default=0)
+        for name, t in self.topics.items():
+            order = np.argsort(t['timestamps'], kind='stable')
+            timestamps = t['timestamps'][order]
+            first = np.searchsorted(timestamps, bag_start + int(start * 1e9)) if start is not None else 0
+            last = np.searchsorted(timestamps, bag_start + int(end * 1e9)) if end is not None else len(timestamps)
+            kept = order[first:last]
+            if decimation and decimation > 1:
+                kept = kept[::decimation]
+            rate = (topic_rates or {}).get(name, max_rate)
+            if rate and len(kept):
+                # at most one message per 1 / rate long period
+                periods = (t['timestamps'][kept] - t['timestamps'][kept[0]]) // int(1e9 / rate)
+                kept = kept[np.concatenate(([True], periods[1:] != periods[:-1]))]
+            if max_messages:
+                kept = kept[:max_messages]
+            for f in self.FIELDS:
+                if t[f] is not None:
+                    t[f] = t[f][kept]
+        self.filtered = True
+        log_and_print(f'Filters keep {sum(len(t["ids"]) for t in self.topics.values())} messages', self.logger)
+
+
+def reopen_zip(path, compression=zipfile.ZIP_DEFLATED, file=None):
+    # reopen a zip for appending, through file if given. If an interrupted run left it without
+    # a central directory, keep the complete entries by walking their local headers and cut off the rest
+    if zipfile.is_zipfile(path):
+        return zipfile.ZipFile(file or path, 'a', compression)
+
+    entries = []
+    size = os.path.getsize(path)
+    offset = 0
+    with open(path, 'rb') as f:
+        while offset + 30 <= size:
+            f.seek(offset)
+            (signature, _, flag_bits, compress_type, dostime, dosdate, crc, compress_size, file_size,
+             name_length, extra_length) = struct.unpack('<IHHHHHIIIHH', f.read(30))
+            if signature != 0x04034b50:
+                break
+            name = f.read(name_length).decode('utf-8' if flag_bits & 0x800 else 'cp437')
+            extra = f.read(extra_length)
+
+            # real sizes of large entries are in the zip64 extra field
+            i = 0
+            while i + 4 <= len(extra):
+                tag, length = struct.unpack_from('<HH', extra, i)
+                if tag == 1:
+                    sizes = iter(struct.unpack_from(f'<{length // 8}Q', extra, i + 4))
+                    if file_size == 0xffffffff:
+                        file_size = next(sizes)
+                    if compress_size == 0xffffffff:
+                        compress_size = next(sizes)
+                i += 4 + length
+
+            # sizes and crc are only filled in once an entry is complete, a chunked entry
+            # has its placeholder sizes in the zip64 extra field
+            if crc == 0 and compress_size == 0:
+                break
+            end = offset + 30 + name_length + extra_length + compress_size
+            if end > size:
+                break
+
+            zinfo = zipfile.ZipInfo(name, ((dosdate >> 9) + 1980, (dosdate >> 5) & 0xf, dosdate & 0x1f,
+                                           dostime >> 11, (dostime >> 5) & 0x3f, (dostime & 0x1f) * 2))
+            zinfo.flag_bits = flag_bits
+            zinfo.compress_type = compress_type
+            zinfo.CRC = crc
+            zinfo.compress_size = compress_size
+            zinfo.file_size = file_size
+            zinfo.header_offset = offset
+            zinfo.external_attr = 0o600 << 16
+            entries.append(zinfo)
+            offset = end
+
+    # appending to a file that's not a zip starts a new central directory after its end
+    os.truncate(path, offset)
+    zipf = zipfile.ZipFile(file or path, 'a', compression)
+    for zinfo in entries:
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+    return zipf
+
+
+def deflate_chunk(chunk, level):
+    # raw deflate stream ending on a byte boundary, so chunks compressed apart can be concatenated
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def zip64_local_header(zinfo):
+    # local file header of a zip entry with its crc and sizes, in the zip64 layout zipfile writes with force_zip64
+    try:
+        name = zinfo.filename.encode('ascii')
+        flag_bits = zinfo.flag_bits & ~0x800
+    except UnicodeEncodeError:
+        name = zinfo.filename.encode('utf-8')
+        flag_bits = zinfo.flag_bits | 0x800
+    year, month, day, hour, minute, second = zinfo.date_time
+    extra = zinfo.extra + struct.pack('<HHQQ', 1, 16, zinfo.file_size, zinfo.compress_size)
+    return struct.pack('<IBBHHHHIIIHH', 0x04034b50, max(zinfo.extract_version, 45), zinfo.reserved, flag_bits,
+                       zinfo.compress_type, hour << 11 | minute << 5 | second // 2,
+                       (year - 1980) << 9 | month << 5 | day, zinfo.CRC, 0xffffffff, 0xffffffff,
+                       len(name), len(extra)) + name + extra
+
+
+class Archive:
+    # common part of the archive writers
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_tree(self, root, prefix=''):
+        for directory, _, files in sorted(os.walk(root)):
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                self.write(path, os.path.join(prefix, os.path.relpath(path, root)))
+
+
+class ParallelZip(Archive):
+    # zip writer that stores already compressed media as is and deflates large files in chunks on every core
+    STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.mp4', '.mkv', '.avi', '.webm',
+                         '.zip', '.gz', '.bz2', '.xz', '.zst', '.npz', '.mcap')
+    CHUNK_SIZE = 4 << 20
+
+    def __init__(self, path, level=None, executor=None, resume=False, workers=None):
+        self.level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        # the file is kept here, so the headers of chunked entries can be written to it
+        if resume and os.path.isfile(path):
+            self.file = open(path, 'r+b')
+            self.zipf = reopen_zip(path, file=self.file)
+        else:
+            self.file = open(path, 'w+b')
+            self.zipf = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED, compresslevel=self.level)
+        self.own_executor = executor is None
+        # threads of the executor, the shared compress pool has one per cpu
+        self.workers = workers or os.cpu_count()
+        self.executor = executor or ThreadPoolExecutor(max_workers=self.workers)
+
+    def namelist(self):
+        return self.zipf.namelist()
+
+    def stored(self, name):
+        return name.lower().endswith(self.STORED_EXTENSIONS) or self.level == 0
+
+    def write(self, path, arcname):
+        if self.stored(path):
+            self.zipf.write(path, arcname, zipfile.ZIP_STORED)
+        elif os.path.getsize(path) <= self.CHUNK_SIZE:
+            self.zipf.write(path, arcname, zipfile.ZIP_DEFLATED, self.level)
+        else:
+            self.write_chunked(path, arcname)
 
-        # Start threads to capture stdout and stderr
-        threading.Thread(target=log_stream, args=(process.stdout, "stdout", logger), daemon=True).start()
-        threading.Thread(target=log_stream, args=(process.stderr, "stderr", logger), daemon=True).start()
+    def writestr(self, arcname, data):
+        zinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+        zinfo.external_attr = 0o644 << 16
+        if self.stored(arcname):
+            self.zipf.writestr(zinfo, data, zipfile.ZIP_STORED)
+        else:
+            self.zipf.writestr(zinfo, data, zipfile.ZIP_DEFLATED, self.level)
+
+    def write_chunked(self, path, arcname):
+        # the chunks deflated on the executor are written as the data of a stored entry,
+        # which is then turned into a deflated entry of the file: crc, sizes and local header
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        # keep a few chunks per thread compressing ahead of the writer
+        ahead = self.workers * 2
+        compressed = collections.deque()
+        crc = size = 0
+        with open(path, 'rb') as f, self.zipf.open(zinfo, 'w', force_zip64=True) as dest:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                compressed.append(self.executor.submit(deflate_chunk, chunk, self.level))
+                while len(compressed) > ahead:
+                    dest.write(compressed.popleft().result())
+            while compressed:
+                dest.write(compressed.popleft().result())
+            # an empty final block ends the stream
+            dest.write(zlib.compressobj(self.level, zlib.DEFLATED, -15).flush())
+
+        # the central directory is written from the entry at close
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        end = self.file.tell()
+        self.file.seek(zinfo.header_offset)
+        self.file.write(zip64_local_header(zinfo))
+        self.file.seek(end)
+
+    def close(self):
+        self.zipf.close()
+        self.file.close()
+        if self.own_executor:
+            self.executor.shutdown()
+
+
+def reopen_tar(path):
+    # reopen a tar for appending. Cut off a member an interrupted run left incomplete
+    # by walking the headers, and put the end of archive marker after the last complete one
+    size = os.path.getsize(path)
+    offset = complete = 0
+    with open(path, 'rb') as f:
+        while offset + 512 <= size:
+            f.seek(offset)
+            try:
+                member = tarfile.TarInfo.frombuf(f.read(512), tarfile.ENCODING, 'surrogateescape')
+            except tarfile.HeaderError:
+                break
+            offset += 512 + -(-member.size // 512) * 512
+            if offset > size:
+                break
+            # long name and pax headers belong to the member after them
+            if member.type not in (tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.GNUTYPE_LONGNAME,
+                                   tarfile.GNUTYPE_LONGLINK):
+                complete = offset
+
+    with open(path, 'r+b') as f:
+        f.truncate(complete)
+        f.seek(complete)
+        f.write(bytes(2 * 512))
+    return tarfile.open(path, 'a')
+
+
+class TarArchive(Archive):
+    # uncompressed tar, nothing to compress in parallel, images are already compressed
+    def __init__(self, path, resume=False):
+        if resume and os.path.isfile(path):
+            self.tarf = reopen_tar(path)
+        else:
+            self.tarf = tarfile.open(path, 'w')
+
+    def namelist(self):
+        return self.tarf.getnames()
+
+    def write(self, path, arcname):
+        self.tarf.add(path, arcname, recursive=False)
+
+    def writestr(self, arcname, data):
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0o644
+        self.tarf.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.tarf.close()
+
+
+class FrameArchiver:
+    # appends files to an archive from its own thread as they are produced
+    def __init__(self, archive, queue_size=256, governor=None):
+        self.governor = governor
+        self.archive = archive
+        self.frame_count = 0
+        self.busy_time = 0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='FrameArchiver', daemon=True)
+        self.thread.start()
+
+    def put(self, path, arcname, remove=False, on_done=None, data=None):
+        # blocks while the queue is full. Frames given as data are archived without touching the disk
+        if self.error:
+            raise self.error
+        self.queue.put((path, arcname, remove, on_done, data))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.archive.close()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        for path, arcname, remove, on_done, data in iter(self.queue.get, None):
+            if self.error:
+                continue
+            try:
+                with self.governor.slot('zip') if self.governor else contextlib.nullcontext():
+                    start = time.monotonic()
+                    if data is None:
+                        self.archive.write(path, arcname)
+                    else:
+                        self.archive.writestr(arcname, data)
+                    self.busy_time += time.monotonic() - start
+                    self.frame_count += 1
+                if remove:
+                    os.remove(path)
+                if on_done:
+                    on_done()
+            except Exception as e:
+                self.error = e
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def output_fingerprint(path, checksum=False):
+    # size and modification time tell changed outputs apart without reading them,
+    # the checksum of archives of large bags would mean reading hundreds of GB again
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if checksum:
+        fingerprint['sha256'] = file_sha256(path)
+    return fingerprint
+
+
+class Manifest:
+    # status, per topic progress and output fingerprints of every stage, so an interrupted run can be resumed.
+    # With checksums set outputs are hashed as well, and the hashes verified when resuming
+    def __init__(self, output_path, bag, resume=False, logger=None, checksums=False):
+        self.path = os.path.join(output_path, 'manifest.json')
+        self.output_path = output_path
+        self.bag = bag
+        self.logger = logger
+        self.checksums = checksums
+        self.lock = threading.Lock()
+        self.last_save = 0
+        self.stages = {}
+
+        if resume and os.path.isfile(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest['bag'] != bag:
+                raise ValueError(f'{output_path} was created from {manifest["bag"]}, not {bag}')
+            self.stages = manifest['stages']
+        self.save()
+
+    def done(self, stage):
+        # a finished stage only counts if its outputs are unchanged
+        status = self.stages.get(stage)
+        if not status or status['status'] != 'done':
+            return False
+        for name, recorded in status['outputs'].items():
+            if isinstance(recorded, str):
+                # manifests of older runs only have checksums
+                recorded = {'sha256': recorded}
+            if self.changed(os.path.join(self.output_path, name), recorded):
+                log_and_print(f'{name} is missing or changed, {stage} will be redone', self.logger)
+                return False
+        return True
+
+    def changed(self, path, recorded):
+        if not os.path.isfile(path):
+            return True
+        if 'size' in recorded and output_fingerprint(path) != {k: recorded[k] for k in ('size', 'mtime_ns')}:
+            return True
+        # checksums are only read again when asked for, or when they are all there is
+        if 'sha256' in recorded and (self.checksums or 'size' not in recorded):
+            return file_sha256(path) != recorded['sha256']
+        return False
+
+    def start(self, stage):
+        with self.lock:
+            status = self.stages.get(stage)
+            # keep the progress of a partially done stage
+            if not status or status['status'] != 'running':
+                self.stages[stage] = {'status': 'running', 'topics': {}, 'outputs': {}}
+        self.save()
+
+    def advance(self, stage, topic, stamp):
+        with self.lock:
+            progress = self.stages[stage]['topics'].setdefault(topic, {'frames': 0})
+            progress['frames'] += 1
+            progress['last_stamp'] = int(stamp)
+        if time.monotonic() - self.last_save > 5:
+            self.save()
+
+    def finish(self, stage, outputs=()):
+        fingerprints = {os.path.relpath(p, self.output_path): output_fingerprint(p, self.checksums)
+                        for p in outputs if os.path.isfile(p)}
+        with self.lock:
+            self.stages.setdefault(stage, {'topics': {}})
+            self.stages[stage].update(status='done', outputs=fingerprints)
+        self.save()
+
+    def save(self):
+        with self.lock:
+            self.last_save = time.monotonic()
+            with open(self.path + '.part', 'w') as f:
+                json.dump({'bag': self.bag, 'stages': self.stages}, f, indent=2)
+            os.replace(self.path + '.part', self.path)
+
+
+class ModelCache:
+    # local store of the yolov5 hub repo, the weights and their exported versions,
+    # so loading the blurring model needs no network after the first run
+    YOLOV5_REPO = 'ultralytics/yolov5'
+    DEFAULT_WEIGHTS_URL = 'https://github.com/ultralytics/yolov5/releases/download/v7.0/yolov5s.pt'
+    EXPORT_SUFFIXES = {'torchscript': '.torchscript', 'onnx': '.onnx'}
+
+    def __init__(self, cache_dir=None, logger=None):
+        self.cache_dir = os.path.realpath(os.path.expanduser(cache_dir or '~/.cache/parse_ros2bag/models'))
+        self.weights_dir = os.path.join(self.cache_dir, 'weights')
+        self.exports_dir = os.path.join(self.cache_dir, 'exports')
+        self.logger = logger
+        os.makedirs(self.weights_dir, exist_ok=True)
+        os.makedirs(self.exports_dir, exist_ok=True)
+        torch.hub.set_dir(os.path.join(self.cache_dir, 'hub'))
+
+    def hub_repo(self):
+        repo = os.path.join(torch.hub.get_dir(), self.YOLOV5_REPO.replace('/', '_') + '_master')
+        if not os.path.isfile(os.path.join(repo, 'hubconf.py')):
+            log_and_print(f'Downloading {self.YOLOV5_REPO} into {self.cache_dir}', self.logger)
+            torch.hub.list(self.YOLOV5_REPO, trust_repo=True)
+        return repo
+
+    def store(self, name, source=None):
+        # copy or download weights into the store and record their checksum
+        path = os.path.join(self.weights_dir, name)
+        if source:
+            shutil.copyfile(source, path + '.part')
+        else:
+            log_and_print(f'Downloading {self.DEFAULT_WEIGHTS_URL} into {self.cache_dir}', self.logger)
+            torch.hub.download_url_to_file(self.DEFAULT_WEIGHTS_URL, path + '.part')
+        os.replace(path + '.part', path)
+        with open(path + '.sha256', 'w') as f:
+            f.write(file_sha256(path))
+        return path
+
+    def weights(self, weights=None):
+        name = os.path.basename(weights) if weights else os.path.basename(self.DEFAULT_WEIGHTS_URL)
+        path = os.path.join(self.weights_dir, name)
+
+        if not os.path.isfile(path + '.sha256'):
+            return self.store(name, weights)
+
+        with open(path + '.sha256') as f:
+            checksum = f.read().strip()
+        if weights and file_sha256(weights) != checksum:
+            log_and_print(f'{weights} changed, updating cached copy', self.logger)
+            return self.store(name, weights)
+        if not os.path.isfile(path) or file_sha256(path) != checksum:
+            raise RuntimeError(f'Checksum mismatch for cached weights {path}, delete it to fetch them again')
+        return path
+
+    def export(self, repo, weights, model_format):
+        # export once with yolov5's own export script, keyed by the checksum of the weights
+        with open(weights + '.sha256') as f:
+            checksum = f.read().strip()
+        suffix = self.EXPORT_SUFFIXES[model_format]
+        path = os.path.join(self.exports_dir, checksum[:16] + suffix)
+        if os.path.isfile(path):
+            return path
+
+        log_and_print(f'Exporting {weights} to {model_format}', self.logger)
+        run_logged_subprocess([
+            sys.executable, 'export.py',
+            '--weights', weights,
+            '--include', model_format,
+            '--imgsz', '640',
+            '--device', 'cpu',
+            ], cwd=repo, logger=self.logger)
+
+        exported = os.path.splitext(weights)[0] + suffix
+        if not os.path.isfile(exported):
+            raise RuntimeError(f'Exporting {weights} to {model_format} failed')
+        os.replace(exported, path)
+        return path
+
+    def load(self, weights=None, model_format='pt'):
+        repo = self.hub_repo()
+        path = self.weights(weights)
+        if model_format and model_format != 'pt':
+            path = self.export(repo, path, model_format)
+        return torch.hub.load(repo, 'custom', path=path, source='local', verbose=False)
+
+
+class DetectionCache:
+    # detections of recently blurred frames of every topic, keyed by a difference hash of the downscaled
+    # grayscale frame. Frames within threshold bits of a cached frame of the same topic reuse its detections
+    # instead of going through the model. With propagate the reused detections are cached for the new
+    # frame too, so slowly changing scenes keep reusing them, otherwise frames are always compared
+    # to frames that went through the model
+    HASH_SIZE = 8
+
+    def __init__(self, threshold, size=None, propagate=False):
+        self.threshold = threshold
+        self.size = size or 16
+        self.propagate = propagate
+        self.entries = collections.defaultdict(collections.OrderedDict) # topic -> hash -> detections, oldest first
+
+    @classmethod
+    def hashes(cls, images):
+        # one row of HASH_SIZE bytes per image, a bit per neighbouring pixel pair
+        gray = np.stack([cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (cls.HASH_SIZE + 1, cls.HASH_SIZE),
+                                    interpolation=cv2.INTER_AREA) for image in images])
+        return np.packbits((gray[:, :, 1:] > gray[:, :, :-1]).reshape(len(images), -1), axis=1)
+
+    @staticmethod
+    def distances(hashes, frame_hash):
+        return np.unpackbits(np.bitwise_xor(hashes, frame_hash), axis=1).sum(axis=1)
+
+    def lookup(self, topic, frame_hash):
+        entries = self.entries[topic]
+        if not entries:
+            return None
+        hashes = np.frombuffer(b''.join(entries), dtype=np.uint8).reshape(len(entries), -1)
+        distances = self.distances(hashes, frame_hash)
+        nearest = int(distances.argmin())
+        if distances[nearest] > self.threshold:
+            return None
+        key = list(entries)[nearest]
+        entries.move_to_end(key)
+        return entries[key]
+
+    def add(self, topic, frame_hash, detections):
+        entries = self.entries[topic]
+        entries[frame_hash.tobytes()] = detections
+        entries.move_to_end(frame_hash.tobytes())
+        while len(entries) > self.size:
+            entries.popitem(last=False)
+
+
+class Blurrer:
+    # long-lived blurring service: the model is loaded once and frames of every topic
+    # are fed through a bounded queue and run through the model in batches on the cpu
+    models = {}
+    models_lock = threading.Lock()
+
+    def __init__(self, weights=None, classes=None, batch_size=8, threads=None, queue_size=64,
+                 model_cache=None, model_format=None, governor=None, logger=None, detection_cache=None):
+        self.weights = weights
+        self.governor = governor
+        self.detection_cache = detection_cache
+        self.model_cache = model_cache or ModelCache(logger=logger)
+        self.model_format = model_format or 'pt'
+        self.classes = classes
+        self.batch_size = batch_size or 8
+        self.threads = threads or os.cpu_count()
+        self.logger = logger
 
-        return process
+        self.queue = queue.Queue(maxsize=queue_size or 64)
+        self.error = None
+        self.frame_count = 0
+        self.inferred_count = 0
+        self.busy_time = 0
+        self.thread = threading.Thread(target=self.run, name='Blurrer', daemon=True)
+        self.thread.start()
+
+    def load_model(self):
+        torch.set_num_threads(self.threads)
+        # loaded models are kept for the next bags converted in the same process
+        key = (self.model_cache.cache_dir, self.weights, self.model_format,
+               tuple(self.classes) if self.classes is not None else None)
+        with Blurrer.models_lock:
+            if key not in Blurrer.models:
+                model = self.model_cache.load(self.weights, self.model_format)
+                model.to('cpu')
+                model.eval()
+                model.classes = self.classes
+                Blurrer.models[key] = model
+            return Blurrer.models[key]
+
+    def put(self, in_path, out_path, on_done=None, data=None, topic=None):
+        # blocks while the queue is full. Frames given as encoded data are blurred in memory
+        # and handed to on_done encoded instead of being written to out_path.
+        # Only frames of the same topic reuse each other's detections
+        if self.error:
+            raise self.error
+        if self.governor:
+            self.governor.wait_for_memory(lambda: not self.queue.empty())
+        self.queue.put((in_path, out_path, on_done, data, topic))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+        if self.detection_cache:
+            log_and_print(f'Blurred {self.frame_count} frames, {self.inferred_count} of them through the model',
+                          self.logger)
+        else:
+            log_and_print(f'Blurred {self.frame_count} frames', self.logger)
+
+    def run(self):
+        done = False
+        try:
+            self.model = self.load_model()
+            with ThreadPoolExecutor(max_workers=self.threads) as io:
+                while not done:
+                    # wait for one frame, then fill up the batch with whatever is already queued
+                    batch = [self.queue.get()]
+                    while batch[-1] is not None and len(batch) < self.batch_size:
+                        try:
+                            batch.append(self.queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    if batch[-1] is None:
+                        done = True
+                        batch.pop()
+                    if batch:
+                        with self.governor.slot('blur') if self.governor else contextlib.nullcontext():
+                            start = time.monotonic()
+                            self.blur_batch(batch, io)
+                            self.busy_time += time.monotonic() - start
+        except Exception as e:
+            self.error = e
+            # keep draining so producers don't block forever
+            while not done:
+                done = self.queue.get() is None
+
+    @staticmethod
+    def read_image(in_path, data):
+        if data is None:
+            return cv2.imread(in_path)
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def detect(self, images):
+        with torch.no_grad():
+            # the model expects rgb images
+            results = self.model([image[:, :, ::-1] for image in images])
+        self.inferred_count += len(images)
+        boxes = []
+        for detections in results.xyxy:
+            boxes.append([(max(int(x1), 0), max(int(y1), 0), int(x2), int(y2))
+                          for x1, y1, x2, y2, _, _ in detections.tolist()])
+        return boxes
+
+    def cached_detect(self, images, topics):
+        # frames close to a cached frame of their topic, or to an earlier frame of their topic
+        # in this batch, don't go through the model
+        hashes = self.detection_cache.hashes(images)
+        boxes = [None] * len(images)
+        infer = []
+        follows = {} # frame -> earlier frame of the batch it reuses
+        for i, (topic, frame_hash) in enumerate(zip(topics, hashes)):
+            boxes[i] = self.detection_cache.lookup(topic, frame_hash)
+            if boxes[i] is not None:
+                continue
+            earlier = [j for j in infer if topics[j] == topic]
+            if earlier:
+                distances = self.detection_cache.distances(hashes[earlier], frame_hash)
+                if distances.min() <= self.detection_cache.threshold:
+                    follows[i] = earlier[int(distances.argmin())]
+                    continue
+            infer.append(i)
+
+        if infer:
+            for i, detections in zip(infer, self.detect([images[i] for i in infer])):
+                boxes[i] = detections
+                self.detection_cache.add(topics[i], hashes[i], detections)
+        for i, j in follows.items():
+            boxes[i] = boxes[j]
+        if self.detection_cache.propagate:
+            for i in range(len(images)):
+                if i not in infer:
+                    self.detection_cache.add(topics[i], hashes[i], boxes[i])
+        return boxes
+
+    def blur_batch(self, batch, io):
+        images = list(io.map(self.read_image, *zip(*[(in_path, data) for in_path, _, _, data, _ in batch])))
+        topics = [topic for _, _, _, _, topic in batch]
+        if self.detection_cache and None not in topics:
+            boxes = self.cached_detect(images, topics)
+        else:
+            boxes = self.detect(images)
+
+        for image, detections in zip(images, boxes):
+            for x1, y1, x2, y2 in detections:
+                if x2 <= x1 or y2 <= y1:
+                    continue
+                kernel = max(x2 - x1, y2 - y1) // 4 * 2 + 1
+                image[y1:y2, x1:x2] = cv2.GaussianBlur(image[y1:y2, x1:x2], (kernel, kernel), 0)
+
+        blurred = list(io.map(self.write_image, batch, images))
+        self.frame_count += len(batch)
+
+        for (_, out_path, on_done, _, _), data in zip(batch, blurred):
+            if on_done:
+                on_done(out_path, data)
+
+    @staticmethod
+    def write_image(item, image):
+        # frames that came in memory go back encoded
+        _, out_path, _, data, _ = item
+        if data is not None:
+            return cv2.imencode('.jpg', image)[1].tobytes()
+        # write under a temporary name first, so a finished frame is never a partial file
+        part_path = os.path.splitext(out_path)[0] + '.part.jpg'
+        cv2.imwrite(part_path, image)
+        os.replace(part_path, out_path)
+
+
+# encoders tried for previews, hardware ones first, with the options they are used with
+# when they replace the encoder asked for
+PREVIEW_ENCODERS = {
+        'h264_nvenc': ['-preset', 'p5', '-cq', '23'],
+        'h264_qsv': ['-global_quality', '23'],
+        'h264_videotoolbox': ['-q:v', '60'],
+        'libx264': ['-preset', 'fast', '-crf', '23'],
+        }
+# output options that belong to an encoder, dropped with it
+ENCODER_OPTIONS = {'-c:v', '-vcodec', '-codec:v', '-preset', '-rc', '-qp', '-cq', '-crf', '-tune', '-profile:v',
+                   '-level', '-global_quality', '-q:v', '-b:v', '-maxrate', '-bufsize', '-x264-params', '-x265-params'}
+CODEC_FLAGS = ('-c:v', '-vcodec', '-codec:v')
+working_encoders = {}
+
+
+def encoder_works(encoder, logger=None):
+    # encodes a single frame, listed encoders may still lack the hardware or driver. The probe runs
+    # in a group of its own, so an encoder failing doesn't cancel the processes of a bag
+    if encoder not in working_encoders:
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'color=black:size=256x256:rate=1',
+               '-frames:v', '1', '-pix_fmt', 'yuv420p', '-c:v', encoder, '-f', 'null', '-']
+        try:
+            run_logged_subprocess(cmd, group=ProcessGroup(60, logger))
+            working_encoders[encoder] = True
+        except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            working_encoders[encoder] = False
+    return working_encoders[encoder]
+
+
+def select_encoder(output_options, encoder=None, logger=None):
+    # the encoder asked for (or the one in the output options) if it works on this machine, otherwise the
+    # first working one of PREVIEW_ENCODERS, which 'auto' picks from directly. Returns the output options
+    # for it and the encoder
+    options = output_options.split()
+    given = next((options[i + 1] for i, o in enumerate(options[:-1]) if o in CODEC_FLAGS), None)
+    requested = None if encoder == 'auto' else encoder or given
+    if requested and requested == given and encoder_works(given, logger):
+        return options, given
+
+    # options of other encoders are dropped, the rest (filters, pixel format) are kept
+    kept = []
+    i = 0
+    while i < len(options):
+        if options[i] in ENCODER_OPTIONS:
+            i += 2
+            continue
+        kept.append(options[i])
+        i += 1
+    candidates = ([requested] if requested and encoder_works(requested, logger)
+                  else [e for e in PREVIEW_ENCODERS if encoder_works(e, logger)])
+    if not candidates:
+        log_and_print('No working preview encoder found, leaving the choice to ffmpeg', logger)
+        return options, given
+    if requested and candidates[0] != requested:
+        log_and_print(f'Encoder {requested} is not available, encoding previews with {candidates[0]}', logger)
+    return kept + ['-c:v', candidates[0]] + PREVIEW_ENCODERS.get(candidates[0], []), candidates[0]
+
+
+def segment_bounds(count, segments):
+    # first and last (exclusive) frame of every segment
+    bounds = np.linspace(0, count, segments + 1).astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def concat_videos(files, out_file, logger=None, group=None):
+    # joins the segments without encoding them again
+    list_file = out_file + '.segments.txt'
+    with open(list_file, 'w') as f:
+        for path in files:
+            escaped = os.path.realpath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    cmd = ['ffmpeg', '-y']
+    if logger:
+        cmd.append('-nostats')
+    cmd += ['-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', out_file]
+    run_logged_subprocess(cmd, logger=logger, group=group)
+    os.remove(list_file)
+
+
+class PreviewStream:
+    # composes the preview mosaics in process as soon as all their frames are ready and pipes them
+    # to ffmpeg as raw video, so the video is encoded while the bag is still being read and blurred.
+    # matches holds the stamps of the frames of every mosaic, one column per topic. With several segments,
+    # consecutive parts of the video are encoded by their own ffmpeg in parallel and joined at the end
+    def __init__(self, topics, matches, frames, out_file, cols=None, rows=None, tile_size=None,
+                 ffmpeg_options='', ffmpeg_input_options='', ffmpeg_output_options='', logger=None, processes=None,
+                 segments=1):
+        self.cols = cols or math.ceil(math.sqrt(len(topics)))
+        self.rows = rows or math.ceil(len(topics) / self.cols)
+        if len(topics) > self.cols * self.rows:
+            log_and_print(f'Preview grid only has room for {", ".join(topics[:self.cols * self.rows])}', logger)
+        self.topics = topics[:self.cols * self.rows]
+        self.matches = matches
+        self.frames = frames
+        self.out_file = out_file
+        self.tile_size = tile_size
+        self.ffmpeg_options = ffmpeg_options
+        self.ffmpeg_input_options = ffmpeg_input_options
+        self.ffmpeg_output_options = ffmpeg_output_options
+        self.logger = logger
+        self.processes = processes
+
+        self.segments = segment_bounds(len(matches), max(1, min(segments or 1, len(matches))))
+        if len(self.segments) == 1:
+            self.segment_files = [out_file]
+        else:
+            os.makedirs(out_file + '.segments', exist_ok=True)
+            extension = os.path.splitext(out_file)[1]
+            self.segment_files = [os.path.join(out_file + '.segments', f'{i:04d}{extension}')
+                                  for i in range(len(self.segments))]
+        self.error = None
+        self.closed = False
+        self.aborted = False
+        self.frame_counts = [0] * len(self.segments)
+        self.busy_times = [0] * len(self.segments)
+        self.lock = threading.Lock()
+        self.unstarted = []
+        self.ready = threading.Condition()
+        self.version = 0
+        self.threads = [threading.Thread(target=self.run, args=(i, first, last), name=f'PreviewStream-{i}', daemon=True)
+                        for i, (first, last) in enumerate(self.segments)]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def frame_count(self):
+        return sum(self.frame_counts)
+
+    @property
+    def busy_time(self):
+        return sum(self.busy_times)
+
+    def notify(self):
+        # a frame became ready
+        with self.ready:
+            self.version += 1
+            self.ready.notify_all()
+
+    def wait_ready(self, seen):
+        with self.ready:
+            self.ready.wait_for(lambda: self.version != seen)
+            return self.version
+
+    def close(self):
+        # frames that never became ready are left black
+        self.closed = True
+        self.notify()
+        for thread in self.threads:
+            thread.join()
+        if self.error:
+            raise self.error
+        for encoder in self.unstarted:
+            if self.tile_size:
+                encoder.start([])
+                error = encoder.finish()
+                if error:
+                    raise error
+        if len(self.segments) > 1:
+            # segments without any frame were never started
+            files = [f for f in self.segment_files if os.path.isfile(f)]
+            if files:
+                concat_videos(files, self.out_file, self.logger, self.processes)
+            shutil.rmtree(self.out_file + '.segments')
+        log_and_print(f'Encoded {self.frame_count} preview frames', self.logger)
+
+    def abort(self):
+        # the rest of the frames won't come, don't finish the video
+        self.aborted = self.closed = True
+        self.notify()
+        for thread in self.threads:
+            thread.join()
+
+    def run(self, segment, first, last):
+        encoder = PreviewEncoder(self, self.segment_files[segment])
+        try:
+            with ThreadPoolExecutor(max_workers=len(self.topics)) as io:
+                seen = None
+                final = False
+                i = first
+                while i < last and not final and not self.aborted:
+                    seen = self.wait_ready(seen)
+                    final = self.closed
+                    while i < last and not self.aborted:
+                        paths = [self.frames[t].get(stamp) for t, stamp in zip(self.topics, self.matches[i])]
+                        if None in paths and not final:
+                            break
+                        start = time.monotonic()
+                        encoder.write(list(io.map(self.read_tile, paths)))
+                        self.busy_times[segment] += time.monotonic() - start
+                        self.frame_counts[segment] += 1
+                        i += 1
+        except Exception as e:
+            self.error = e
+        finally:
+            if encoder.skipped and encoder.process is None and not self.aborted:
+                # only black mosaics so far, their size may come from the other segments
+                self.unstarted.append(encoder)
+            error = encoder.finish(self.aborted or self.error is not None)
+            if error and not self.error:
+                self.error = error
+
+    def read_tile(self, path):
+        image = cv2.imread(path) if path else None
+        if image is not None and self.tile_size and image.shape[1::-1] != self.tile_size:
+            image = cv2.resize(image, self.tile_size, interpolation=cv2.INTER_AREA)
+        return image
+
+    def frame_size(self, images):
+        # tiles are the size of the first frame unless given, rounded to even for yuv420p.
+        # Every segment uses the same size
+        with self.lock:
+            width, height = self.tile_size or next(image for image in images if image is not None).shape[1::-1]
+            self.tile_size = (width // 2 * 2, height // 2 * 2)
+            return self.tile_size
+
+
+class PreviewEncoder:
+    # one ffmpeg process of a PreviewStream, fed the raw mosaics of one segment of the video
+    def __init__(self, stream, out_file):
+        self.stream = stream
+        self.out_file = out_file
+        self.process = None
+        self.mosaic = None
+        # black mosaics waiting for the frame size
+        self.skipped = 0
+
+    def start(self, images):
+        stream = self.stream
+        width, height = stream.frame_size(images)
+        self.mosaic = np.zeros((stream.rows * height, stream.cols * width, 3), dtype=np.uint8)
+
+        cmd = ['ffmpeg', '-y']
+        if stream.logger:
+            cmd.append('-nostats')
+        cmd += [
+            *stream.ffmpeg_options.split(),
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{self.mosaic.shape[1]}x{self.mosaic.shape[0]}',
+            *stream.ffmpeg_input_options.split(),
+            '-i', '-',
+            *stream.ffmpeg_output_options.split(),
+            self.out_file
+            ]
+        if stream.logger:
+            stream.logger.info(f'Creating video with {cmd}')
+        self.process = Popen_logged_subprocess(cmd, logger=stream.logger, stdin=subprocess.PIPE, group=stream.processes)
+        self.stdin = self.process.stdin
+        for _ in range(self.skipped):
+            self.stdin.write(self.mosaic.data)
+        self.skipped = 0
+
+    def write(self, images):
+        # mosaics without any frame are black, so the video keeps the timing of the matches
+        if self.process is None:
+            if all(image is None for image in images) and self.stream.tile_size is None:
+                self.skipped += 1
+                return
+            self.start(images)
+
+        width, height = self.stream.tile_size
+        for i, image in enumerate(images):
+            row, col = divmod(i, self.stream.cols)
+            tile = self.mosaic[row * height:(row + 1) * height, col * width:(col + 1) * width]
+            if image is None:
+                tile[:] = 0
+            else:
+                if image.shape[1::-1] != self.stream.tile_size:
+                    image = cv2.resize(image, self.stream.tile_size, interpolation=cv2.INTER_AREA)
+                tile[:] = image
+        self.stdin.write(self.mosaic.data)
+
+    def finish(self, aborted=False):
+        # returns the error if ffmpeg failed
+        if self.process is None:
+            return None
+        if aborted:
+            self.process.kill()
+        try:
+            self.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        if self.process.returncode and not aborted:
+            return RuntimeError(f'ffmpeg failed with exit code {self.process.returncode}')
+        return None
+
+
+class ConcurrencyGovernor:
+    # process wide limits shared by every bag: the image export processes, the number of blurring batches,
+    # zip writers and preview encoders running at once, and backpressure on producers while memory use is too high
+    def __init__(self, export_workers=None, blur_workers=None, zip_workers=None, encoders=None,
+                 memory_limit=None, logger=None):
+        self.export_workers = export_workers or os.cpu_count()
+        self.slots = {
+                'blur': threading.BoundedSemaphore(blur_workers or 1),
+                'zip': threading.BoundedSemaphore(zip_workers or 2),
+                'encode': threading.BoundedSemaphore(encoders or 1),
+                }
+        self.memory_limit = memory_limit * 1024 * 1024 if memory_limit else None
+        self.logger = logger
+
+        self.lock = threading.Lock()
+        self.pool = None
+        self.compress_executor = None
+        self.memory_used = 0
+        self.memory_checked = 0
+
+    def export_pool(self):
+        # one pool of export processes for every bag
+        with self.lock:
+            if self.pool is None:
+                self.pool = ImageExportPool(self.export_workers, self)
+            return self.pool
+
+    def compress_pool(self):
+        # threads deflating zip chunks, zlib releases the GIL
+        with self.lock:
+            if self.compress_executor is None:
+                self.compress_executor = ThreadPoolExecutor(max_workers=os.cpu_count(),
+                                                            thread_name_prefix='deflate')
+            return self.compress_executor
+
+    def slot(self, kind):
+        return self.slots[kind]
+
+    def rss(self):
+        # memory of this process and its children, sampling them is not free so reuse recent values
+        now = time.monotonic()
+        if now - self.memory_checked > 0.5:
+            process = psutil.Process()
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.memory_used, self.memory_checked = rss, now
+        return self.memory_used
+
+    def wait_for_memory(self, busy):
+        # only wait while the caller has work in flight that will free memory when done
+        if not self.memory_limit:
+            return
+        logged = False
+        while self.rss() > self.memory_limit and busy():
+            if not logged:
+                if self.logger:
+                    self.logger.info(f'Memory use over {self.memory_limit // (1024 * 1024)} MB, waiting')
+                logged = True
+            time.sleep(0.1)
+
+    def close(self):
+        with self.lock:
+            if self.pool:
+                self.pool.shutdown()
+                self.pool = None
+            if self.compress_executor:
+                self.compress_executor.shutdown()
+                self.compress_executor = None
+
+
+class StageProfiler:
+    # wall and cpu time, disk io and peak memory of every stage, and counts of what they processed.
+    # Cpu time, io and memory are of the whole process and its children while the stage ran,
+    # stages running at the same time share them
+    METRICS = ('wall_time', 'cpu_time', 'read_bytes', 'write_bytes', 'peak_rss')
+
+    def __init__(self):
+        self.process = psutil.Process()
+        self.stages = {} # name -> metrics
+        self.counts = collections.defaultdict(collections.Counter) # name -> item -> count
+        self.running = {} # name -> peak rss so far
+        self.lock = threading.Lock()
+        self.sampler = None
+
+    def snapshot(self):
+        cpu = read_bytes = write_bytes = rss = 0
+        for process in [self.process] + self.process.children(recursive=True):
+            try:
+                with process.oneshot():
+                    times = process.cpu_times()
+                    io_counters = process.io_counters()
+                    cpu += times.user + times.system
+                    read_bytes += io_counters.read_bytes
+                    write_bytes += io_counters.write_bytes
+                    rss += process.memory_info().rss
+            except psutil.Error:
+                pass
+        # finished children
+        times = self.process.cpu_times()
+        cpu += times.children_user + times.children_system
+        return time.monotonic(), cpu, read_bytes, write_bytes, rss
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = self.snapshot()
+        with self.lock:
+            self.running[name] = start[4]
+            if self.sampler is None or not self.sampler.is_alive():
+                self.sampler = threading.Thread(target=self.sample, name='StageProfiler', daemon=True)
+                self.sampler.start()
+        try:
+            yield
+        finally:
+            end = self.snapshot()
+            with self.lock:
+                peak = max(self.running.pop(name), end[4])
+                self.stages[name] = dict(zip(self.METRICS, [e - s for e, s in zip(end[:4], start[:4])] + [peak]))
+
+    def sample(self):
+        # peak memory of the running stages
+        while self.running:
+            rss = self.snapshot()[4]
+            with self.lock:
+                for name in self.running:
+                    self.running[name] = max(self.running[name], rss)
+            time.sleep(0.5)
+
+    def count(self, stage, item, n=1):
+        with self.lock:
+            self.counts[stage][item] += n
+
+    def status(self):
+        # one line summary of the running stages and counts, for the progress display
+        with self.lock:
+            running = ', '.join(self.running) or 'waiting'
+            counts = ', '.join(f'{stage} {sum(v for k, v in c.items() if k != "busy_time")}'
+                               for stage, c in self.counts.items())
+        return f'{running} [{counts}]' if counts else running
+
+    def write(self, output_path, bag):
+        stages = {name: {**self.stages.get(name, {}), 'counts': dict(self.counts.get(name, {}))}
+                  for name in list(self.stages) + [n for n in self.counts if n not in self.stages]}
+        with open(os.path.join(output_path, 'profile.json'), 'w') as f:
+            json.dump({'bag': bag, 'stages': stages}, f, indent=2)
+        with open(os.path.join(output_path, 'profile.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', *self.METRICS, 'busy_time', 'count'])
+            for name, stage in stages.items():
+                counts = stage['counts']
+                writer.writerow([name, *(stage.get(m, '') for m in self.METRICS), counts.get('busy_time', ''),
+                                 sum(v for k, v in counts.items() if k != 'busy_time')])
+
+
+class ProgressDisplay:
+    # rewrites one status line per bag on the terminal while parsing
+    def __init__(self, bag_parsers, interval=1):
+        self.bag_parsers = bag_parsers
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lines = 0
+        self.thread = threading.Thread(target=self.run, name='ProgressDisplay', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.show()
+
+    def show(self):
+        # move back up over the previous lines
+        lines = [f'{os.path.basename(p.bag)}: {p.profiler.status()}' for p in self.bag_parsers]
+        sys.stderr.write(f'\033[{self.lines}F' if self.lines else '')
+        sys.stderr.write(''.join(f'\033[2K{line}\n' for line in lines))
+        sys.stderr.flush()
+        self.lines = len(lines)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.show()
+
+
+class JobScheduler:
+    # runs jobs as soon as their dependencies are done, with a separate concurrency limit for each resource
+    DEFAULT_LIMITS = {'cpu': 2, 'io': 2, 'ffmpeg': 1}
+
+    def __init__(self, limits=None, logger=None):
+        self.limits = {**self.DEFAULT_LIMITS, **{k: v for k, v in (limits or {}).items() if v}}
+        self.logger = logger
+        self.jobs = {} # name -> (resource, function, dependencies)
+        self.done = set()
+        self.failed = {} # name -> exception
+
+    def add(self, name, resource, function, dependencies=()):
+        self.jobs[name] = (resource, function, list(dependencies))
+
+    def run(self):
+        pending = dict(self.jobs)
+        running = {}
+        free = dict(self.limits)
+        with ThreadPoolExecutor(max_workers=sum(self.limits.values())) as executor:
+            while pending or running:
+                # jobs are started in the order they were added, so earlier bags go first
+                for name, (resource, function, dependencies) in list(pending.items()):
+                    if any(d in self.failed for d in dependencies):
+                        self.failed[name] = RuntimeError(f'{name} skipped, a dependency failed')
+                        del pending[name]
+                    elif all(d in self.done for d in dependencies) and free[resource] > 0:
+                        free[resource] -= 1
+                        running[executor.submit(function)] = name
+                        del pending[name]
+
+                if not running:
+                    # all that's left may have been skipped after a failure
+                    if pending:
+                        raise RuntimeError(f'Jobs with unmet dependencies: {", ".join(pending)}')
+                    break
+
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    free[self.jobs[name][0]] += 1
+                    if future.exception() is not None:
+                        self.failed[name] = future.exception()
+                        log_and_print(f'{name} failed: {future.exception()!r}', self.logger)
+                    else:
+                        self.done.add(name)
+
+
+# message type -> (kind, exporter factory). The kind is the part of the pipeline the topic goes through:
+# 'image' topics are exported, blurred, synced, previewed and zipped, 'pointcloud' and 'misc' topics are
+# only exported. The factory is called as factory(parser, topic) and returns the topic's Exporter
+EXPORTERS = {}
+EXPORTER_KINDS = ('image', 'pointcloud', 'misc')
+
+
+def register_exporter(msg_type, kind, factory, exporters=None):
+    # registers for every parser, or only in the given exporters mapping
+    if kind not in EXPORTER_KINDS:
+        raise ValueError(f'Unknown exporter kind {kind}, expected one of {", ".join(EXPORTER_KINDS)}')
+    (EXPORTERS if exporters is None else exporters)[msg_type] = (kind, factory)
 
 
 class ROS2BagParser:
-    image_topic_names = []
-    pointcloud_topic_names = []
-    misc_topic_names = []
-
-    topic_types = {
-            'sensor_msgs/msg/Image': image_topic_names,
-            'sensor_msgs/msg/CompressedImage': image_topic_names,
-            'sensor_msgs/msg/PointCloud2': pointcloud_topic_names,
-            'sensor_msgs/msg/NavSatFix': misc_topic_names,
-            'sensor_msgs/msg/TimeReference': misc_topic_names,
-            'geometry_msgs/msg/TwistStamped': misc_topic_names,
-            'tf2_msgs/msg/TFMessage': misc_topic_names,
-            'rcl_interfaces/msg/Log': misc_topic_names,
-            'std_msgs/msg/Int32': misc_topic_names,
-            }
+    STAGES = ('bag_zip', 'export', 'blur', 'zip', 'pointcloud', 'misc', 'sync', 'preview')
+
+    # rough size of an exported png relative to the raw image, for plans
+    PNG_RATIO = 0.5
 
     def __init__(self,
                  bag,
@@ -91,10 +2374,35 @@ class ROS2BagParser:
                  topic_blacklist,
                  preview_config, preview_topics, preview_cols, preview_rows, preview_image_width, preview_image_height,
                  ffmpeg_options, ffmpeg_input_options, ffmpeg_output_options,
-                 logger):
+                 logger,
+                 export_workers=None,
+                 blur_weights=None, blur_classes=None, blur_batch_size=None, blur_threads=None, blur_queue_size=None,
+                 model_cache_dir=None, blur_model_format=None,
+                 index_dir=None,
+                 resume=False,
+                 job_limits=None,
+                 governor=None,
+                 zip_level=None,
+                 direct=False, archive_format=None,
+                 pointcloud_format=None,
+                 misc_formats=None,
+                 start_time=None, end_time=None, decimation=None, max_rate=None, topic_rates=None, max_messages=None,
+                 blur_dedup_threshold=None, blur_dedup_cache_size=None, blur_dedup_propagate=False,
+                 process_timeout=None,
+                 exporters=None,
+                 preview_encoder=None, preview_segments=None,
+                 checksums=False):
         self.script_path = os.path.dirname(os.path.realpath(__file__))
         self.bag = bag
 
+        # topic lists are per instance, several parsers can run in one process.
+        # exporters adds to or overrides the registered ones for this parser
+        self.exporters = {**EXPORTERS, **(exporters or {})}
+        self.topic_names = {kind: [] for kind in EXPORTER_KINDS}
+        self.image_topic_names = self.topic_names['image']
+        self.pointcloud_topic_names = self.topic_names['pointcloud']
+        self.misc_topic_names = self.topic_names['misc']
+
         self.output_path = output_path
         self.image_path = os.path.join(output_path, 'images')
         self.synced_path = os.path.join(output_path, 'synced_topics')
@@ -102,9 +2410,18 @@ class ROS2BagParser:
         self.preview_path = os.path.join(output_path, 'previews')
         self.pointcloud_path = os.path.join(output_path, 'pointclouds')
         self.misc_path = os.path.join(output_path, 'misc_topics')
+        self.pointcloud_format = pointcloud_format
+        self.misc_formats = misc_formats
 
         self.keep = keep
         self.zip = zip_
+        self.zip_level = zip_level
+        self.archive_format = archive_format or 'zip'
+        # frames go straight from export and blurring into the archive, intermediaries aren't written
+        self.direct = direct and zip_ and not keep
+        if direct and not self.direct:
+            log_and_print('Direct archiving needs zipping on and intermediaries off, writing frames to folders',
+                          logger)
 
         self.sync = sync
         self.sync_slop = sync_slop
@@ -121,27 +2438,173 @@ class ROS2BagParser:
         self.ffmpeg_options = ffmpeg_options
         self.ffmpeg_input_options = ffmpeg_input_options
         self.ffmpeg_output_options = ffmpeg_output_options
+        self.preview_encoder = preview_encoder
+        self.preview_segments = preview_segments
+
+        self.export_workers = export_workers
+
+        self.blur_weights = blur_weights
+        self.blur_classes = blur_classes
+        self.blur_batch_size = blur_batch_size
+        self.blur_threads = blur_threads
+        self.blur_queue_size = blur_queue_size
+        self.model_cache_dir = model_cache_dir
+        self.blur_model_format = blur_model_format
+        self.blur_dedup_threshold = blur_dedup_threshold
+        self.blur_dedup_cache_size = blur_dedup_cache_size
+        self.blur_dedup_propagate = blur_dedup_propagate
+
+        self.index_dir = index_dir
+
+        self.start_time = start_time
+        self.end_time = end_time
+        self.decimation = decimation
+        self.max_rate = max_rate
+        self.topic_rates = {'/' + t: rate for t, rate in (topic_rates or {}).items()} # topics begint with / for some reason
+        self.max_messages = max_messages
+
+        self.resume = resume
+        self.checksums = checksums
+        self.job_limits = job_limits
+        # without a shared governor this parser gets its own
+        self.owns_governor = governor is None
+        self.governor = governor or ConcurrencyGovernor(export_workers, logger=logger)
+        self.manifest = None
+        self.done_stages = set()
+
+        self.topic_msg_types = {}
+        self.frames = {} # topic -> header stamp -> path of the exported (and blurred) frame
+        self.image_export_pool = None
+        self.image_archiver = None
+        self.index = None
+        self.blurrer = None
+        self.preview = None
+        self.matches = None
+        self.sinks = {}
+        self.profiler = StageProfiler()
+        # external processes of this bag, killed together when one of them or a stage fails
+        self.processes = ProcessGroup(process_timeout, logger)
 
         self.logger = logger
 
+    def image_stages(self):
+        return ['export'] + (['blur'] if self.blurred_path else []) + (['zip'] if self.zip else [])
+
+    def create_sinks(self):
+        # route every topic we care about to its exporters, so the bag is only read once
+        sinks = {}
+        for t in self.image_topic_names:
+            self.frames[t] = {}
+
+        if self.image_topic_names and not set(self.image_stages()) <= self.done_stages:
+            for stage in self.image_stages():
+                self.manifest.start(stage)
+            self.image_export_pool = self.governor.export_pool()
+            if self.zip:
+                self.image_archiver = FrameArchiver(self.archive('pictures', self.resume), governor=self.governor)
+            if self.resume:
+                self.recover_frames()
+
+            for t in self.image_topic_names:
+                sinks.setdefault(t, []).append(self.exporter(t))
+
+        if self.pointcloud_topic_names and 'pointcloud' not in self.done_stages:
+            self.manifest.start('pointcloud')
+            for t in self.pointcloud_topic_names:
+                sinks.setdefault(t, []).append(self.exporter(t))
+
+        if self.misc_topic_names and 'misc' not in self.done_stages:
+            self.manifest.start('misc')
+            for t in self.misc_topic_names:
+                sinks.setdefault(t, []).append(self.exporter(t))
+
+        return sinks
+
+    def exporter(self, topic):
+        return self.exporters[self.topic_msg_types[topic]][1](self, topic)
+
+    def image_exporter(self, topic):
+        if self.direct:
+            # only the frames of the preview are written to files
+            if topic in self.preview_topics:
+                os.makedirs((self.blurred_path or self.image_path) + topic, exist_ok=True)
+        elif self.blurred_path:
+            os.makedirs(self.blurred_path + topic, exist_ok=True)
+        return ImageSink(self.topic_msg_types[topic], self.image_path + topic, self.image_export_pool, self.frame_exported,
+                         (lambda t, stamp: stamp in self.frames[t]) if self.resume else None, self.direct)
+
+    def pointcloud_exporter(self, topic):
+        return PointcloudSink(self.topic_msg_types[topic], self.pointcloud_path + topic, self.governor.export_pool(),
+                              self.pointcloud_format, self.resume)
+
+    def misc_exporter(self, topic):
+        return MiscSink(self.topic_msg_types[topic], self.misc_path + topic, self.misc_formats)
+
+    def recover_frames(self):
+        # frames finished by an interrupted run: the ones in the zip, or in the final folder when not zipping
+        final_path = self.blurred_path or self.image_path
+        if self.image_archiver:
+            names = self.image_archiver.archive.namelist()
+        elif self.zip:
+            with self.archive('pictures', resume=True) as archive:
+                names = archive.namelist()
+        else:
+            names = [os.path.relpath(os.path.join(root, f), final_path)
+                     for root, _, files in os.walk(final_path) for f in files]
+
+        for name in names:
+            topic, frame = '/' + os.path.dirname(name), os.path.basename(name)
+            stem = os.path.splitext(frame)[0]
+            # unfinished frames are named <stamp>.part.<extension>
+            if topic in self.frames and stem.isdigit():
+                self.frames[topic][int(stem)] = os.path.join(final_path + topic, frame)
+
+    def frame_exported(self, topic, stamp, path, data=None):
+        # data is the encoded frame in direct mode, path is where it would have been written
+        self.manifest.advance('export', topic, stamp)
+        self.profiler.count('export', topic)
+        # exported frames go straight on to blurring, or to the zip if there's no blurring
+        if self.blurrer:
+            # blurred version is always .jpg
+            blurred_path = os.path.join(self.blurred_path + topic, os.path.splitext(os.path.basename(path))[0] + '.jpg')
+            self.blurrer.put(path, blurred_path,
+                             lambda blurred_path, blurred: self.frame_blurred(topic, stamp, path, blurred_path, blurred),
+                             data, topic)
+        else:
+            self.frame_ready(topic, stamp, path, data)
+
+    def frame_blurred(self, topic, stamp, image_path, blurred_path, data=None):
+        self.manifest.advance('blur', topic, stamp)
+        if not self.keep and data is None:
+            os.remove(image_path)
+        self.frame_ready(topic, stamp, blurred_path, data)
+
+    def frame_ready(self, topic, stamp, path, data=None):
+        if data is not None and topic in self.preview_topics:
+            # the preview is made from files
+            with open(path + '.part', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.part', path)
+        self.frames[topic][stamp] = path
+        if self.preview and topic in self.preview_topics:
+            self.preview.notify()
+        if self.image_archiver:
+            # frames of preview topics are still needed after zipping
+            self.image_archiver.put(path, topic[1:] + '/' + os.path.basename(path),
+                                    remove=data is None and not self.keep and topic not in self.preview_topics,
+                                    on_done=lambda: self.manifest.advance('zip', topic, stamp), data=data)
+
     def parse_pointclouds(self):
-        if not self.pointcloud_topic_names:
+        if not self.pointcloud_topic_names or 'pointcloud' in self.done_stages:
             return
 
         log_and_print('Pointcloud parsing started', self.logger)
-        log_and_print('Exporting pointcoulds', self.logger)
-        # export pointclouds
-        for t in self.pointcloud_topic_names:
-                run_logged_subprocess([
-                'ros2', 'bag', 'export',
-                '--in', self.bag,
-                '-t', t, 'pcd',
-                '--dir', self.pointcloud_path + t,
-                ], logger=self.logger)
-
         if self.zip:
             log_and_print('Zipping pointclouds', self.logger)
-            shutil.make_archive(self.output_path + '/pointcloud', 'zip', self.pointcloud_path)
+            with self.governor.slot('zip'), self.archive('pointcloud') as archive:
+                archive.write_tree(self.pointcloud_path)
+
+        self.manifest.finish('pointcloud', [self.archive_file('pointcloud')] if self.zip else [])
 
         if not self.keep and self.zip:
             # cleanup
@@ -149,42 +2612,45 @@ class ROS2BagParser:
 
         log_and_print('Pointcould parsing finished', self.logger)
 
-    def export_images(self, image_topic_name):
-        # export images
-        run_logged_subprocess([
-            'ros2', 'bag', 'export',
-            '--in', self.bag,
-            '-t', image_topic_name, 'image',
-            '--dir', self.image_path + image_topic_name,
-            ], logger=self.logger)
-
-    def export_and_blur_images(self, image_topic_name):
-        self.export_images(image_topic_name)
+    def preview_matches(self):
+        # stamps of the frames of every preview mosaic, preview topics are among the sync topics when syncing
+        if self.sync:
+            return self.sync_matches()[:, [self.sync_topics.index(t) for t in self.preview_topics]]
+        stamps = [self.index.header_stamps(t) for t in self.preview_topics]
+        count = min(len(s) for s in stamps)
+        return np.stack([s[:count] for s in stamps], axis=1)
+
+    def start_preview(self):
+        # the mosaics are made in process, unless create_preview.py has to do it for its config
+        if not self.preview_topics or self.preview_config:
+            return None
+        log_and_print('Creating preview', self.logger)
+        tile_size = None
+        if self.preview_image_width and self.preview_image_height:
+            tile_size = (self.preview_image_width, self.preview_image_height)
+        output_options, segments = self.preview_encoding()
+        return PreviewStream(self.preview_topics, self.preview_matches(), self.frames, f'{self.output_path}/preview.mp4',
+                             self.preview_cols, self.preview_rows, tile_size,
+                             self.ffmpeg_options, self.ffmpeg_input_options, output_options, self.logger,
+                             self.processes, segments)
+
+    def preview_encoding(self):
+        # output options with a working encoder, and the number of segments encoded in parallel.
+        # Software encoders get a share of the cpus each, a hardware encoder is fast enough on its own
+        options, encoder = select_encoder(self.ffmpeg_output_options, self.preview_encoder, self.logger)
+        software = encoder is None or encoder.startswith('lib')
+        cpus = os.cpu_count() or 1
+        segments = self.preview_segments or (max(1, cpus // 4) if software else 1)
+        if software and segments > 1 and '-threads' not in options:
+            options = options + ['-threads', str(max(1, cpus // segments))]
+        if self.logger:
+            self.logger.info(f'Encoding previews with {encoder or "the ffmpeg default"} in {segments} segments')
+        return ' '.join(options), segments
 
-        run_logged_subprocess([
-            'python3', 'licenseplate_test.py',
-            '-i', self.image_path + image_topic_name,
-            '-o', self.blurred_path + image_topic_name,
-            ],
-            cwd=self.script_path + '/person_and_licenceplate_blurring',
-            logger=self.logger)
-
-    def copy_blurred(self, thread, proc, topic):
-        # wait for blur thread
-        thread.join()
-
-        # wait for synced export process
-        proc.wait()
-
-        # go through synced images' folder and copy their blurred version in it
-        for f in os.listdir(self.synced_path + topic):
-            # remove original to avoid duplicates if there are .pngs (may be unneccessary)
-            os.remove(os.path.join(self.synced_path + topic, f))
-
-            # copy blurred version (always .jpg)
-            shutil.copy(self.blurred_path + topic +
-                        '/' + os.path.splitext(f)[0] + '.jpg',
-                        self.synced_path + topic)
+    def abort_preview(self):
+        if self.preview:
+            self.preview.abort()
+            self.preview = None
 
     def create_preview(self, image_path):
         if not self.preview_topics:
@@ -209,244 +2675,233 @@ class ROS2BagParser:
             cmd.append(f'-ih {str(self.preview_image_height)}')
         cmd.append('-t')
         cmd += [t[1:] for t in self.preview_topics]
-        run_logged_subprocess(cmd, cwd=image_path, logger=self.logger)
+        run_logged_subprocess(cmd, cwd=image_path, logger=self.logger, group=self.processes)
 
-        # create video
-        if self.logger:
-            self.logger.info(f'Creating video with {cmd}')
-        cmd = ["ffmpeg"]
-        if self.logger:
-            cmd.append("-nostats")
-        cmd += [
-            *self.ffmpeg_options.split(),
-            *self.ffmpeg_input_options.split(),
-            "-i", "frame_%04d.jpg",
-            *self.ffmpeg_output_options.split(),
-            f"{self.output_path}/preview.mp4"
-            ]
-        run_logged_subprocess(cmd, cwd=self.preview_path, logger=self.logger)
+        # create video, consecutive segments of the frames are encoded in parallel and joined
+        output_options, segments = self.preview_encoding()
+        numbers = sorted(int(f[6:10]) for f in os.listdir(self.preview_path) if re.fullmatch(r'frame_\d{4}\.jpg', f))
+        if not numbers:
+            log_and_print('No preview frames were created, skipping video', self.logger)
+            return
+        bounds = segment_bounds(len(numbers), max(1, min(segments, len(numbers))))
+        out_file = f'{self.output_path}/preview.mp4'
+        files = [out_file] if len(bounds) == 1 else \
+            [f'{self.preview_path}/segment_{i:04d}.mp4' for i in range(len(bounds))]
+        cmds = []
+        for (first, last), file in zip(bounds, files):
+            cmd = ["ffmpeg", "-y"]
+            if self.logger:
+                cmd.append("-nostats")
+            cmd += [
+                *self.ffmpeg_options.split(),
+                *self.ffmpeg_input_options.split(),
+                "-start_number", str(numbers[0] + first),
+                "-i", "frame_%04d.jpg",
+                "-frames:v", str(last - first),
+                *output_options.split(),
+                file
+                ]
+            if self.logger:
+                self.logger.info(f'Creating video with {cmd}')
+            cmds.append(cmd)
+        with ThreadPoolExecutor(max_workers=len(cmds)) as executor:
+            for future in [executor.submit(run_logged_subprocess, cmd, self.preview_path, self.logger, self.processes)
+                           for cmd in cmds]:
+                future.result()
+        if len(files) > 1:
+            concat_videos(files, out_file, self.logger, self.processes)
+            for file in files:
+                os.remove(file)
 
         # cleanup
         if not self.keep:
             shutil.rmtree(self.preview_path)
 
-    def sync_and_export_images(self):
+    def stamp_topics(self):
+        # topics whose header stamps the remaining sync and preview stages match
+        topics = []
+        if self.sync and not {'sync', 'preview'} <= self.done_stages:
+            topics += self.sync_topics
+        if 'preview' not in self.done_stages:
+            topics += self.preview_topics
+        return topics
+
+    def sync_matches(self):
+        # header stamps come from the bag index, no need to read the messages again.
+        # The read pass adds the ones the index doesn't have yet
+        if self.matches is None:
+            self.matches = match_stamps({t: self.index.header_stamps(t) for t in self.sync_topics},
+                                        int((self.sync_slop or 0) * 1000000000))
+        return self.matches
+
+    def sync_images(self):
         log_and_print('Synchronizing topics', self.logger)
-        # create config file
-        sync_config = f'extract -t {" ".join(self.sync_topics)}\nsync -t {" ".join(self.sync_topics)}'
-        if self.sync_slop:
-            sync_config += f' --slop {str(self.sync_slop)}'
-        with open(self.output_path + '/sync.config', 'w') as file: # sync needs an empty folder
-            file.write(sync_config)
-
-        # syncronize and extract
-        cmd = ['ros2', 'bag', 'process',
-               self.bag,
-               '-c', self.output_path + '/sync.config',
-               '-o', self.synced_path]
-        run_logged_subprocess(cmd, logger=self.logger)
-
-        # cleanup
-        if self.keep:
-            os.rename(self.output_path + '/sync.config', self.synced_path + '/sync.config')
-        else:
-            os.remove(self.output_path + '/sync.config')
-
-        # export synced preview images
-        synced_image_export_processes = []
+        topics = self.sync_topics
+        matches = self.sync_matches()
+        log_and_print(f'Found {len(matches)} synchronized frames', self.logger)
+
+        # index of the matched frames, named as in the image folders and the zip.
+        # Topics without frames (gps, ...) only get their stamps
+        with open(self.output_path + '/sync_index.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([c for t in topics for c in (t + '/stamp', t + '/frame')])
+            for match in matches:
+                writer.writerow([c for t, stamp in zip(topics, match)
+                                 for c in (stamp, t[1:] + '/' + os.path.basename(self.frames[t][stamp])
+                                           if t in self.frames else '')])
+
+        # folders of synced preview images, for create_preview.py or kept as intermediaries.
+        # link them instead of copying
+        if not self.preview_config and not self.keep:
+            return
         for t in self.preview_topics:
-            synced_image_export_processes.append(Popen_logged_subprocess([
-                'ros2', 'bag', 'export',
-                '--in', self.synced_path + '/synced_topics_0.db3',
-                '-t', t, 'image',
-                '--dir', self.synced_path + t,
-                ], logger=self.logger))
-
-        # return processes so they can be waited on
-        return synced_image_export_processes
-
-    def zip_images(self, image_export_threads, image_path):
-        # wait for image exports to finish
-        for t in image_export_threads:
-            t.join()
-
-        log_and_print('Zipping images', self.logger)
-        # zip images in a separate process
-        zipping_process = multiprocessing.Process(
-                target=shutil.make_archive,
-                args=(self.output_path + '/pictures', 'zip', image_path)
-                )
-        zipping_process.start()
-        zipping_process.join()
-
-    def parse_images(self):
+            os.makedirs(self.synced_path + t, exist_ok=True)
+            for stamp in matches[:, topics.index(t)]:
+                frame = self.frames[t][stamp]
+                try:
+                    os.link(frame, os.path.join(self.synced_path + t, os.path.basename(frame)))
+                except OSError:
+                    shutil.copy(frame, self.synced_path + t)
+
+    def finish_images(self):
         if not self.image_topic_names:
             return
 
-        log_and_print('Image parsing started', self.logger)
-        # with blurring
-        if self.blurred_path:
-            # get blurring model
-            torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True, force_reload=True)
-
-            log_and_print('Exporting and blurring images', self.logger)
-            # export and blur images
-            image_export_threads = []
-            for t in self.image_topic_names:
-                image_export_threads.append(threading.Thread(target=self.export_and_blur_images, args=(t,)))
-                image_export_threads[-1].start()
+        # frames are exported, blurred and zipped while the bag is read, wait for the rest
+        if self.image_export_pool:
+            self.manifest.finish('export')
+        else:
+            # nothing was read, everything comes from the previous run
+            self.recover_frames()
+
+        if self.blurrer:
+            log_and_print('Finishing blurring', self.logger)
+            self.blurrer.close()
+            self.profiler.count('blur', 'frames', self.blurrer.frame_count)
+            self.profiler.count('blur', 'busy_time', self.blurrer.busy_time)
+            self.manifest.finish('blur')
+
+        if self.image_archiver:
+            log_and_print('Finishing zipping images', self.logger)
+            self.image_archiver.close()
+            self.profiler.count('zip', 'frames', self.image_archiver.frame_count)
+            self.profiler.count('zip', 'busy_time', self.image_archiver.busy_time)
+            self.manifest.finish('zip', [self.archive_file('pictures')])
+
+    def sync_stage(self):
+        if not self.image_topic_names or not self.sync or 'sync' in self.done_stages:
+            return
 
-            if self.zip:
-                # zip images
-                zipping_thread = threading.Thread(
-                        target=self.zip_images, args=(image_export_threads, self.blurred_path))
-                zipping_thread.start()
+        self.manifest.start('sync')
+        self.sync_images()
+        self.manifest.finish('sync', [self.output_path + '/sync_index.csv'])
 
-            # sync if needed
-            if self.sync:
-                synced_image_export_processes = self.sync_and_export_images()
-
-                # copy blurred versions into synced images
-                copying_threads = []
-                # for each topic we'll have to wait for all previous exports
-                for thread, proc, topic in zip(image_export_threads,
-                                               synced_image_export_processes,
-                                               self.image_topic_names):
-                    copying_threads.append(threading.Thread(
-                        target=self.copy_blurred, args=(thread, proc, topic)))
-                    copying_threads[-1].start()
-
-                # create preview video
-                # wait for copying to finish
-                for t in copying_threads:
-                    t.join()
-                self.create_preview(self.synced_path)
+    def preview_stage(self):
+        if not self.image_topic_names or 'preview' in self.done_stages:
+            return
 
+        self.manifest.start('preview')
+        if self.preview_config:
+            with self.governor.slot('encode'):
+                self.create_preview(self.synced_path if self.sync else self.blurred_path or self.image_path)
+        elif self.preview_topics:
+            if not self.preview:
+                # nothing was read, the frames all come from the previous run
+                with self.governor.slot('encode'):
+                    self.preview = self.start_preview()
+                    self.preview.close()
             else:
-                # wait for export and blur to finish
-                for t in image_export_threads:
-                    t.join()
-                # create preview video
-                self.create_preview(self.blurred_path)
-
-        # without blurring
+                self.preview.close()
+            self.profiler.count('preview_encode', 'frames', self.preview.frame_count)
+            self.profiler.count('preview_encode', 'busy_time', self.preview.busy_time)
+            self.preview = None
         else:
-            log_and_print('Exporting images', self.logger)
-            # export images
-            image_export_threads = []
-            for t in self.image_topic_names:
-                image_export_threads.append(threading.Thread(target=self.export_images, args=(t,)))
-                image_export_threads[-1].start()
-
-            # zip images
-            if self.zip:
-                zipping_thread = threading.Thread(
-                        target=self.zip_images, args=(image_export_threads, self.image_path))
-                zipping_thread.start()
-
-            if self.sync:
-                # sync
-                synced_image_export_processes = self.sync_and_export_images()
-
-                # create preview video
-                # wait for all synced_exports
-                for p in synced_image_export_processes:
-                    p.wait()
-                self.create_preview(self.synced_path)
+            log_and_print('No preview topics, skipping step', self.logger)
+        self.manifest.finish('preview', [self.output_path + '/preview.mp4'])
 
-            else:
-                # wait for exports to finish
-                for t in image_export_threads:
-                    t.join()
-                # create preview video
-                self.create_preview(self.image_path)
+    def cleanup_images(self):
+        if not self.image_topic_names:
+            return
 
-        # cleanup
+        # cleanup, folders may already be gone when resuming
         if not self.keep:
             if self.zip:
-                zipping_thread.join()
-                shutil.rmtree(self.image_path)
+                shutil.rmtree(self.image_path, ignore_errors=True)
                 if self.blurred_path:
-                    shutil.rmtree(self.blurred_path)
+                    shutil.rmtree(self.blurred_path, ignore_errors=True)
             else:
                 if self.blurred_path:
-                    shutil.rmtree(self.image_path)
+                    shutil.rmtree(self.image_path, ignore_errors=True)
 
             if self.sync:
-                shutil.rmtree(self.synced_path)
+                shutil.rmtree(self.synced_path, ignore_errors=True)
 
         log_and_print('Image parsing finished', self.logger)
 
     def parse_misc(self):
-        if not self.misc_topic_names:
+        if not self.misc_topic_names or 'misc' in self.done_stages:
             return
 
+        # misc topics are written while the bag is read, kml tracks included
         log_and_print('Misc parsing started', self.logger)
-        log_and_print('Extracting misc topics', self.logger)
-        # extract misc topics
-        run_logged_subprocess([
-            'ros2', 'bag', 'extract',
-            self.bag,
-            '-t', *self.misc_topic_names,
-            '-o', self.misc_path
-            ], logger=self.logger)
-
-        log_and_print('Converting misc topics', self.logger)
-        # convert to csv
-        run_logged_subprocess(['ros2bag-convert', self.misc_path + '/misc_topics_0.db3'], logger=self.logger)
-
-        if '/fix' in self.misc_topic_names:
-            # convert to kml
-            run_logged_subprocess([
-                'python3', self.script_path + '/ros2-csv-kml_converter/csv-to-kml.py',
-                self.misc_path
-                ], logger=self.logger)
-
-        if not self.keep:
-            os.remove(self.misc_path + '/metadata.yaml')
-            os.remove(self.misc_path + '/misc_topics_0.db3')
+        self.manifest.finish('misc', [f for f in glob.glob(self.misc_path + '/**', recursive=True) if os.path.isfile(f)])
 
         log_and_print('Misc parsing finished', self.logger)
 
+    def archive_file(self, name):
+        return f'{self.output_path}/{name}.{self.archive_format}'
+
+    def archive(self, name, resume=False):
+        if self.archive_format == 'tar':
+            return TarArchive(self.archive_file(name), resume)
+        return ParallelZip(self.archive_file(name), self.zip_level, self.governor.compress_pool(), resume)
+
     def zip_bag(self):
         log_and_print('Zipping ros2 bag', self.logger)
-        # zip original bag
-        with zipfile.ZipFile(self.output_path + '/bag.zip', 'w', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(self.bag, arcname=os.path.basename(self.bag))
+        # zip original bag, the database is deflated in chunks on every core
+        with self.archive('bag') as archive:
+            if os.path.isdir(self.bag):
+                archive.write_tree(self.bag, os.path.basename(os.path.normpath(self.bag)))
+            else:
+                archive.write(self.bag, os.path.basename(self.bag))
+
+    def zip_bag_stage(self):
+        if not self.zip or 'bag_zip' in self.done_stages:
+            return
+
+        self.manifest.start('bag_zip')
+        with self.governor.slot('zip'):
+            self.zip_bag()
+        self.manifest.finish('bag_zip', [self.archive_file('bag')])
 
-    def sort_topics(self):
+    def sort_topics(self, topics=None):
         log_and_print('Sorting topics', self.logger)
-        # get topics
-        info = rosbag2_py.Info()
-        metadata = info.read_metadata(self.bag, 'sqlite3')
+        # get topics, from the index unless they are given
+        if topics is None:
+            self.index = BagIndex(self.bag, self.index_dir, self.logger, self.governor.export_pool())
+            self.index.apply_filters(self.start_time, self.end_time, self.decimation, self.max_rate, self.topic_rates,
+                                     self.max_messages)
+            topics = self.index.topics
 
         # separate topic types we care about into lists
-        if self.sync:
-            new_sync_topics = []
-            for t in metadata.topics_with_message_count:
-                if t.topic_metadata.name in self.topic_blacklist:
-                    continue
+        new_sync_topics = []
+        for name, topic in topics.items():
+            if name in self.topic_blacklist:
+                continue
 
-                if t.topic_metadata.name in self.sync_topics:
-                    new_sync_topics.append(t.topic_metadata.name)
+            if self.sync and name in self.sync_topics:
+                new_sync_topics.append(name)
 
-                topic_names = self.topic_types.get(t.topic_metadata.type)
-                if topic_names is not None:
-                    topic_names.append(t.topic_metadata.name)
+            if topic['type'] in self.exporters:
+                self.topic_names[self.exporters[topic['type']][0]].append(name)
+                self.topic_msg_types[name] = topic['type']
 
+        if self.sync:
             if new_sync_topics:
                 self.sync_topics = new_sync_topics
             else:
                 self.sync = False
                 log_and_print('Sync topics not found, step will be skipped', self.logger)
-        else:
-            for t in metadata.topics_with_message_count:
-                if t.topic_metadata.name in self.topic_blacklist:
-                    continue
-
-                topic_names = self.topic_types.get(t.topic_metadata.type)
-                if topic_names is not None:
-                    topic_names.append(t.topic_metadata.name)
 
         if self.preview_topics:
             new_preview_topics = []
@@ -459,35 +2914,298 @@ class ROS2BagParser:
             if new_preview_topics:
                 self.preview_topics = new_preview_topics
             else:
+                self.preview_topics = []
                 log_and_print('Preview topics not found, step will be skipped', self.logger)
 
-    def parse_ros2bag(self):
+    def blur_problem(self):
+        # the stock yolov5s weights know people but no license plates or faces, blurring with them
+        # has to be asked for by picking their classes
+        if self.blurred_path and not self.blur_weights and self.blur_classes is None:
+            return ('Blurring needs weights that detect faces and license plates (blur_weights), '
+                    'or blur_classes to blur only those classes of the stock yolov5s model (0: people)')
+        return None
+
+    def prepare(self):
+        if self.blur_problem():
+            raise ValueError(self.blur_problem())
+
         # make output dir
-        if os.path.isdir(self.output_path) and os.listdir(self.output_path):
-            log_and_print('Error: output path is a non-empty folder.', self.logger)
+        if os.path.isdir(self.output_path) and os.listdir(self.output_path) and not self.resume:
+            log_and_print(f'Error: output path {self.output_path} is a non-empty folder, '
+                          'use --resume to continue a previous run.', self.logger)
             exit()
         os.makedirs(self.output_path, exist_ok=True)
 
-        # start zipping original bag
-        if self.zip:
-            bag_zipping_process = multiprocessing.Process(target=self.zip_bag)
-            bag_zipping_process.start()
+        # stages finished by a previous run are skipped
+        self.manifest = Manifest(self.output_path, self.bag, self.resume, self.logger, self.checksums)
+        if self.resume:
+            self.done_stages = {stage for stage in self.STAGES if self.manifest.done(stage)}
+            log_and_print(f'Resuming, finished stages: {", ".join(sorted(self.done_stages)) or "none"}', self.logger)
 
         # put topics into different lists based on types and options
         self.sort_topics()
 
-        # start independent parsing pipelines
-        pointcloud_parser_thread = threading.Thread(target=self.parse_pointclouds)
-        pointcloud_parser_thread.start()
-        misc_parser_thread = threading.Thread(target=self.parse_misc)
-        misc_parser_thread.start()
-        self.parse_images()
-
+    def planned_count(self, name, count, duration):
+        # messages of a topic the filters would keep, assuming they are spread evenly over the bag
+        if duration and (self.start_time is not None or self.end_time is not None):
+            start = max(self.start_time or 0, 0)
+            end = min(self.end_time if self.end_time is not None else duration, duration)
+            count *= max(end - start, 0) / duration
+            duration = max(end - start, 0)
+        if self.decimation and self.decimation > 1:
+            count = math.ceil(count / self.decimation)
+        rate = self.topic_rates.get(name, self.max_rate)
+        if rate and duration:
+            count = min(count, math.ceil(rate * duration))
+        if self.max_messages:
+            count = min(count, self.max_messages)
+        return int(count)
+
+    def plan(self):
+        # what a run would do, from the bag's metadata: nothing is exported, written or started
+        topics, duration = bag_summary(self.bag)
+        self.sort_topics(topics)
+        counts = {name: self.planned_count(name, t['count'], duration) for name, t in topics.items()}
+
+        def describe(names, size_ratio=1):
+            # total size estimated from the average message size, None if it is unknown
+            for n in names:
+                print(f'    {n} ({topics[n]["type"]}): {counts[n]} messages')
+            if any(topics[n]['size'] is None for n in names):
+                return None
+            return sum(counts[n] * topics[n]['size'] * size_ratio for n in names)
+
+        print(f'Plan for {self.bag} ({bag_storage(self.bag)}, {duration:.1f} s, '
+              f'{sum(os.path.getsize(f) for f in bag_files(self.bag)) / 1e6:.1f} MB)')
+        ignored = [n for n in topics if n not in self.topic_msg_types]
+        print(f'  read: {sum(counts[n] for n in self.topic_msg_types)} of {sum(t["count"] for t in topics.values())} messages'
+              f'{", ignoring " + ", ".join(ignored) if ignored else ""}')
+
+        sizes = {}
+        if self.image_topic_names:
+            print(f'  images -> {self.image_path}')
+            # raw images are written as png, compressed ones as they are
+            compressed = describe([n for n in self.image_topic_names if topics[n]['type'].endswith('/CompressedImage')])
+            raw = describe([n for n in self.image_topic_names if topics[n]['type'].endswith('/Image')], self.PNG_RATIO)
+            sizes['images'] = compressed + raw if compressed is not None and raw is not None else None
+            if self.blurred_path:
+                print(f'  blur -> {self.blurred_path}' + (
+                    f', reusing detections within {self.blur_dedup_threshold} bits' if self.blur_dedup_threshold is not None else ''))
+                if self.blur_problem():
+                    print(f'  error: {self.blur_problem()}, a run would stop here')
+            if self.sync:
+                print(f'  sync {", ".join(self.sync_topics)} with {self.sync_slop} s slop -> {self.synced_path}')
+            if self.preview_topics:
+                print(f'  preview of {", ".join(self.preview_topics)} -> {self.output_path}/preview.mp4')
+            if self.zip:
+                print(f'  zip images into {self.archive_format} archives{" directly" if self.direct else ""}')
+                if not self.keep:
+                    print('  remove image folders')
+        if self.pointcloud_topic_names:
+            print(f'  pointclouds -> {self.pointcloud_path} as {self.pointcloud_format or "binary"}')
+            sizes['pointclouds'] = describe(self.pointcloud_topic_names)
+        if self.misc_topic_names:
+            print(f'  misc topics -> {self.misc_path} as {", ".join(self.misc_formats or ["parquet"])}')
+            sizes['misc topics'] = describe(self.misc_topic_names)
         if self.zip:
-            bag_zipping_process.join()
-        pointcloud_parser_thread.join()
-        misc_parser_thread.join()
-        log_and_print('Finished', self.logger)
+            print(f'  zip bag -> {self.archive_file("bag")}')
+
+        if sizes:
+            print('  estimated output: ' + ', '.join(f'{k} {v / 1e6:.1f} MB' if v is not None else f'{k} unknown (compressed bag)'
+                                                      for k, v in sizes.items()))
+
+    def read_bag(self):
+        # start loading the blurring model while the images are exported
+        if self.blurred_path and self.image_topic_names and not set(self.image_stages()) <= self.done_stages:
+            self.blurrer = Blurrer(self.blur_weights, self.blur_classes,
+                                   self.blur_batch_size, self.blur_threads, self.blur_queue_size,
+                                   ModelCache(self.model_cache_dir, self.logger), self.blur_model_format,
+                                   self.governor, self.logger,
+                                   DetectionCache(self.blur_dedup_threshold, self.blur_dedup_cache_size,
+                                                  self.blur_dedup_propagate)
+                                   if self.blur_dedup_threshold is not None else None)
+
+        # export every topic in a single pass over the bag
+        sinks = self.sinks = self.create_sinks()
+        if self.image_export_pool and 'preview' not in self.done_stages and self.index.has_stamps(self.stamp_topics()):
+            # the preview is encoded as its frames are exported, if the index already knows their stamps
+            self.preview = self.start_preview()
+        # header stamps syncing and the preview need are taken from the messages as they are read
+        stamp_sinks = self.index.stamp_sinks(self.stamp_topics())
+        read_sinks = {t: sinks.get(t, []) + ([stamp_sinks[t]] if t in stamp_sinks else [])
+                      for t in sinks.keys() | stamp_sinks.keys()}
+        if read_sinks:
+            log_and_print('Reading bag', self.logger)
+            bag_reader(self.bag, self.governor.export_pool(), self.logger,
+                       self.index if self.index.filtered else None).read(read_sinks)
+        self.index.add_stamps(stamp_sinks)
+        if self.image_export_pool and 'preview' not in self.done_stages and not self.preview:
+            # otherwise as soon as the stamps are read, so it still runs alongside blurring and zipping
+            self.preview = self.start_preview()
+
+        for topic, topic_sinks in sinks.items():
+            kind = self.exporters[self.topic_msg_types[topic]][0]
+            if kind != 'image':
+                # image frames are counted as they are exported
+                self.profiler.count(kind, topic, sum(getattr(sink, 'count', 0) for sink in topic_sinks))
+
+    def profiled(self, name, function):
+        def run():
+            with self.profiler.stage(name):
+                try:
+                    function()
+                except Exception:
+                    self.processes.cancel()
+                    raise
+        return run
+
+    def write_profile(self):
+        # report of the stages that ran, even if some failed
+        if self.manifest:
+            self.profiler.write(self.output_path, self.bag)
+
+    def add_jobs(self, scheduler, prefix=''):
+        # stages of this bag and the resource each of them is limited by
+        for name, resource, function, dependencies in (
+                ('prepare', 'io', self.prepare, []),
+                ('bag_zip', 'io', self.zip_bag_stage, ['prepare']),
+                ('read', 'cpu', self.read_bag, ['prepare']),
+                ('pointcloud', 'io', self.parse_pointclouds, ['read']),
+                ('misc', 'cpu', self.parse_misc, ['read']),
+                ('images', 'cpu', self.finish_images, ['read']),
+                ('sync', 'io', self.sync_stage, ['images']),
+                ('preview', 'ffmpeg', self.preview_stage, ['sync']),
+                ('cleanup', 'io', self.cleanup_images, ['preview']),
+                ):
+            scheduler.add(prefix + name, resource, self.profiled(name, function), [prefix + d for d in dependencies])
+        scheduler.add(prefix + 'finish', 'io', lambda: log_and_print(f'Finished {self.bag}', self.logger),
+                      [prefix + s for s in ('bag_zip', 'pointcloud', 'misc', 'cleanup')])
+
+    def parse_ros2bag(self):
+        scheduler = JobScheduler(self.job_limits, self.logger)
+        self.add_jobs(scheduler)
+        scheduler.run()
+        self.abort_preview()
+        self.write_profile()
+        if self.owns_governor:
+            self.governor.close()
+        for error in scheduler.failed.values():
+            raise error
+
+
+for msg_type in ('sensor_msgs/msg/Image', 'sensor_msgs/msg/CompressedImage'):
+    register_exporter(msg_type, 'image', ROS2BagParser.image_exporter)
+register_exporter('sensor_msgs/msg/PointCloud2', 'pointcloud', ROS2BagParser.pointcloud_exporter)
+for msg_type in ('sensor_msgs/msg/NavSatFix',
+                 'sensor_msgs/msg/TimeReference',
+                 'geometry_msgs/msg/TwistStamped',
+                 'tf2_msgs/msg/TFMessage',
+                 'rcl_interfaces/msg/Log',
+                 'std_msgs/msg/Int32'):
+    register_exporter(msg_type, 'misc', ROS2BagParser.misc_exporter)
+
+
+def parse_bags(bag_parsers, job_limits=None, governor=None, logger=None):
+    # run the stages of every bag on one scheduler, so they share the concurrency limits
+    scheduler = JobScheduler(job_limits, logger)
+    for i, bag_parser in enumerate(bag_parsers):
+        bag_parser.add_jobs(scheduler, f'{i}:{os.path.basename(bag_parser.bag)}:')
+    scheduler.run()
+    # previews of failed bags are still waiting for frames
+    for bag_parser in bag_parsers:
+        bag_parser.abort_preview()
+        bag_parser.write_profile()
+    if governor:
+        governor.close()
+
+    failed_bags = sorted({name.rsplit(':', 1)[0] for name in scheduler.failed})
+    log_and_print(f'Finished {len(bag_parsers) - len(failed_bags)} of {len(bag_parsers)} bags', logger)
+    for bag in failed_bags:
+        log_and_print(f'Failed: {bag}', logger)
+    return failed_bags
+
+
+def output_dirs(bags, output_dir):
+    # one output subfolder per bag, named after it
+    dirs = []
+    for bag in bags:
+        name = os.path.splitext(os.path.basename(bag))[0]
+        path = os.path.join(os.path.realpath(output_dir), name)
+        i = 1
+        while path in dirs:
+            path = os.path.join(os.path.realpath(output_dir), f'{name}_{i}')
+            i += 1
+        dirs.append(path)
+    return dirs
+
+
+# options of BagConverter, the same as in the config file
+DEFAULT_OPTIONS = {
+        'blur': False, 'keep_intermediary': False, 'zip': True, 'sync': True, 'sync_slop': 0.1,
+        'sync_topics': [], 'topic_blacklist': [],
+        'preview_topics': [], 'preview_cols': None, 'preview_rows': None,
+        'preview_image_width': None, 'preview_image_height': None, 'preview_config': None,
+        'ffmpeg_options': '', 'ffmpeg_input_options': '', 'ffmpeg_output_options': '',
+        'export_workers': None, 'blur_weights': None, 'blur_classes': None, 'blur_batch_size': None,
+        'blur_threads': None, 'blur_queue_size': None, 'model_cache_dir': None, 'blur_model_format': None,
+        'blur_dedup_threshold': None, 'blur_dedup_cache_size': None, 'blur_dedup_propagate': False,
+        'index_dir': None, 'resume': False,
+        'cpu_jobs': None, 'io_jobs': None, 'ffmpeg_jobs': None,
+        'blur_workers': None, 'zip_workers': None, 'encoders': None, 'memory_limit': None,
+        'zip_level': None, 'direct': False, 'archive_format': None,
+        'pointcloud_format': None, 'misc_formats': None,
+        'start_time': None, 'end_time': None, 'decimation': None, 'max_rate': None, 'topic_rates': None,
+        'max_messages': None, 'process_timeout': None, 'preview_encoder': None, 'preview_segments': None,
+        'checksums': False,
+        }
+
+
+class BagConverter:
+    # library entry point for converting bags in a long running process. The worker pools stay up and
+    # the blurring model and dependencies stay loaded between bags, until close
+    def __init__(self, logger=None, **options):
+        unknown = set(options) - DEFAULT_OPTIONS.keys()
+        if unknown:
+            raise TypeError(f'Unknown options: {", ".join(sorted(unknown))}')
+        self.options = {**DEFAULT_OPTIONS, **options}
+        self.logger = logger
+        self.job_limits = {'cpu': self.options['cpu_jobs'], 'io': self.options['io_jobs'],
+                           'ffmpeg': self.options['ffmpeg_jobs']}
+        self.governor = ConcurrencyGovernor(self.options['export_workers'], self.options['blur_workers'],
+                                            self.options['zip_workers'], self.options['encoders'],
+                                            self.options['memory_limit'], logger)
+        # exporters of this converter, on top of the registered ones
+        self.exporters = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def register_exporter(self, msg_type, kind, factory):
+        register_exporter(msg_type, kind, factory, self.exporters)
+
+    def parser(self, bag, output_path):
+        renamed = {'keep_intermediary': 'keep', 'zip': 'zip_'}
+        parameters = inspect.signature(ROS2BagParser).parameters
+        return ROS2BagParser(bag, output_path, logger=self.logger, job_limits=self.job_limits,
+                             governor=self.governor, exporters=self.exporters,
+                             **{renamed.get(k, k): v for k, v in self.options.items() if renamed.get(k, k) in parameters})
+
+    def convert(self, bag, output_path):
+        # raises if any stage fails
+        bag_parser = self.parser(bag, output_path)
+        bag_parser.parse_ros2bag()
+        return bag_parser
+
+    def convert_many(self, bags, output_dir):
+        # returns the bags that failed
+        bag_parsers = [self.parser(bag, path) for bag, path in zip(bags, output_dirs(bags, output_dir))]
+        return parse_bags(bag_parsers, self.job_limits, logger=self.logger)
+
+    def close(self):
+        self.governor.close()
 
 
 def load_config_file(config_path):
@@ -509,6 +3227,41 @@ def load_config_file(config_path):
             'ffmpeg_options': str,
             'ffmpeg_input_options': str,
             'ffmpeg_output_options': str,
+            'export_workers': int,
+            'blur_weights': str,
+            'blur_classes': list,
+            'blur_batch_size': int,
+            'blur_threads': int,
+            'blur_queue_size': int,
+            'model_cache_dir': str,
+            'blur_model_format': str,
+            'index_dir': str,
+            'cpu_jobs': int,
+            'io_jobs': int,
+            'ffmpeg_jobs': int,
+            'blur_workers': int,
+            'zip_workers': int,
+            'encoders': int,
+            'memory_limit': int,
+            'zip_level': int,
+            'direct': bool,
+            'archive_format': str,
+            'pointcloud_format': str,
+            'misc_formats': list,
+            'start_time': float,
+            'end_time': float,
+            'decimation': int,
+            'max_rate': float,
+            'topic_rates': dict,
+            'max_messages': int,
+            'progress': bool,
+            'blur_dedup_threshold': int,
+            'blur_dedup_cache_size': int,
+            'blur_dedup_propagate': bool,
+            'process_timeout': float,
+            'preview_encoder': str,
+            'preview_segments': int,
+            'checksums': bool,
             'logfile': str,
             'verbose': bool
     }
@@ -542,17 +3295,17 @@ if __name__ == '__main__':
                         type=str, default='./config.yaml',
                         help='Path to config file')
     parser.add_argument('input',
-                        type=str,
-                        help='Path to input ROS2 bag')
+                        type=str, nargs='+',
+                        help='Paths or glob patterns of input ROS2 bags, several bags are processed as a batch')
     parser.add_argument('-o', '--output_dir',
                         type=str, required=False, default='./convert',
-                        help='Path to the output folder')
+                        help='Path to the output folder, batches get one subfolder per bag')
     parser.add_argument('-tb', '--topic_blacklist',
                         nargs='*',
                         help='Topics not to parse')
     parser.add_argument('-b', '--blur',
                         action='store_true',
-                        help='Blur faces and license plates')
+                        help='Blur faces and license plates, needs blur_weights detecting them')
     parser.add_argument('-nb', '--no_blur',
                         dest='blur',
                         action='store_false',
@@ -571,6 +3324,12 @@ if __name__ == '__main__':
                         dest='zip',
                         action='store_false',
                         help='Do not zip results')
+    parser.add_argument('-d', '--direct',
+                        action='store_true',
+                        help='Write frames straight into the archive, without image folders (needs zipping and no intermediaries)')
+    parser.add_argument('-af', '--archive_format',
+                        choices=['zip', 'tar'],
+                        help='Format of the result archives (default: zip)')
     parser.add_argument('-s', '--sync',
                         action='store_true', default=True,
                         help='Sync topics')
@@ -584,18 +3343,124 @@ if __name__ == '__main__':
     parser.add_argument('-st', '--sync_topics',
                         nargs='*',
                         help='Topics to synchronize for preview creation')
+    parser.add_argument('-sta', '--start_time',
+                        type=float,
+                        help='Skip messages received before this many seconds from the start of the bag')
+    parser.add_argument('-et', '--end_time',
+                        type=float,
+                        help='Skip messages received after this many seconds from the start of the bag')
+    parser.add_argument('-dc', '--decimation',
+                        type=int,
+                        help='Only keep every n-th message of every topic')
+    parser.add_argument('-mr', '--max_rate',
+                        type=float,
+                        help='Keep at most this many messages per second of every topic')
+    parser.add_argument('-tr', '--topic_rates',
+                        nargs='*', type=lambda s: (s.split('=')[0], float(s.split('=')[1])),
+                        help='Per topic message rate limits as topic=Hz, overriding max_rate')
+    parser.add_argument('-mm', '--max_messages',
+                        type=int,
+                        help='Keep at most this many messages of every topic')
+    parser.add_argument('-pg', '--progress',
+                        action='store_true',
+                        help='Show the running stages and processed counts of every bag while parsing')
     parser.add_argument('-pc', '--preview_config',
                         type=str,
                         help='Path to config file for create_preview.py')
     parser.add_argument('-pt', '--preview_topics',
                         nargs='*',
                         help='Topics to use in preview creation')
+    parser.add_argument('-pf', '--pointcloud_format',
+                        choices=list(PointcloudSink.EXTENSIONS),
+                        help='Format of exported pointclouds, pcd files or numpy arrays (default: binary)')
+    parser.add_argument('-mf', '--misc_formats',
+                        nargs='+', choices=['parquet', 'csv'],
+                        help='Formats of the misc topic tables (default: parquet)')
+    parser.add_argument('-ew', '--export_workers',
+                        type=int,
+                        help='Number of image and pointcloud export processes (default: number of CPUs)')
+    parser.add_argument('-bw', '--blur_weights',
+                        type=str,
+                        help='Path to YOLOv5 weights detecting faces and license plates for blurring (default: stock yolov5s, only with blur_classes)')
+    parser.add_argument('-bc', '--blur_classes',
+                        type=int, nargs='*',
+                        help='Class ids of the blurring model to blur (default: all classes of blur_weights, required without them)')
+    parser.add_argument('-bbs', '--blur_batch_size',
+                        type=int,
+                        help='Number of frames per blurring inference batch (default: 8)')
+    parser.add_argument('-bt', '--blur_threads',
+                        type=int,
+                        help='Number of threads used for blurring (default: number of CPUs)')
+    parser.add_argument('-bq', '--blur_queue_size',
+                        type=int,
+                        help='Maximum number of frames waiting for blurring (default: 64)')
+    parser.add_argument('-mc', '--model_cache_dir',
+                        type=str,
+                        help='Folder to cache the blurring model in (default: ~/.cache/parse_ros2bag/models)')
+    parser.add_argument('-bf', '--blur_model_format',
+                        choices=['pt', 'torchscript', 'onnx'],
+                        help='Format to run the blurring model in, exported once into the model cache (default: pt)')
+    parser.add_argument('-bdt', '--blur_dedup_threshold',
+                        type=int,
+                        help='Reuse the detections of a similar earlier frame of the topic if their 64 bit hashes differ in at most this many bits (default: off)')
+    parser.add_argument('-bdc', '--blur_dedup_cache_size',
+                        type=int,
+                        help='Number of recent frames per topic whose detections are kept for reuse (default: 16)')
+    parser.add_argument('-bdp', '--blur_dedup_propagate',
+                        action='store_true',
+                        help='Keep reusing detections along runs of similar frames, instead of comparing to frames that went through the model')
+    parser.add_argument('-pto', '--process_timeout',
+                        type=float,
+                        help='Seconds an external process (preview creation) may run before it is killed and its stage fails')
+    parser.add_argument('-pe', '--preview_encoder',
+                        type=str,
+                        help='ffmpeg encoder for previews, replaced by a working one if unavailable, auto picks the first working hardware encoder or libx264 (default: the one in ffmpeg_output_options)')
+    parser.add_argument('-ps', '--preview_segments',
+                        type=int,
+                        help='Number of preview segments encoded in parallel (default: a quarter of the CPUs for software encoders, 1 for hardware ones)')
+    parser.add_argument('-id', '--index_dir',
+                        type=str,
+                        help='Folder to keep bag index files in (default: ~/.cache/parse_ros2bag/index)')
+    parser.add_argument('-cj', '--cpu_jobs',
+                        type=int,
+                        help='Number of cpu heavy stages (reading, blurring) running at once (default: 2)')
+    parser.add_argument('-ij', '--io_jobs',
+                        type=int,
+                        help='Number of disk heavy stages (zipping, syncing) running at once (default: 2)')
+    parser.add_argument('-fj', '--ffmpeg_jobs',
+                        type=int,
+                        help='Number of preview encodes running at once (default: 1)')
+    parser.add_argument('-zl', '--zip_level',
+                        type=int,
+                        choices=range(0, 10),
+                        help='Deflate level of zipped non-media files, 0 stores everything (default: 6)')
+    parser.add_argument('-bwk', '--blur_workers',
+                        type=int,
+                        help='Number of blurring batches running at once across all bags (default: 1)')
+    parser.add_argument('-zw', '--zip_workers',
+                        type=int,
+                        help='Number of zip writers running at once across all bags (default: 2)')
+    parser.add_argument('-en', '--encoders',
+                        type=int,
+                        help='Number of preview encoders running at once across all bags (default: 1)')
+    parser.add_argument('-ml', '--memory_limit',
+                        type=int,
+                        help='Memory use in MB above which reading and exporting pause until it drops')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Continue an interrupted run in the same output folder, skipping finished work')
+    parser.add_argument('-cs', '--checksums',
+                        action='store_true',
+                        help='Hash finished outputs and verify the hashes on --resume, instead of comparing sizes and modification times')
     parser.add_argument('-l', '--logfile',
                         type=str,
                         help='Path to log file')
     parser.add_argument('--verbose',
                         action='store_true',
                         help='Print every log message to the terminal')
+    parser.add_argument('-dr', '--dry_run',
+                        action='store_true',
+                        help='Only print what would be done with every bag, from its metadata, without parsing it')
     args_config, remaining_argv = parser.parse_known_args()
 
     # load config file if it exists
@@ -637,24 +3502,45 @@ if __name__ == '__main__':
         logger = None
         print('Starting parser...')
 
-    bag_parser = ROS2BagParser(os.path.realpath(args.input),
-                               os.path.realpath(args.output_dir),
-                               args.blur,
-                               args.keep_intermediary,
-                               args.zip,
-                               args.sync,
-                               args.sync_slop,
-                               getattr(args, 'sync_topics', []),
-                               getattr(args, 'topic_blacklist', []),
-                               getattr(args, 'preview_config', None),
-                               getattr(args, 'preview_topics', None),
-                               getattr(args, 'preview_cols', None),
-                               getattr(args, 'preview_rows', None),
-                               getattr(args, 'preview_image_width', None),
-                               getattr(args, 'preview_image_height', None),
-                               getattr(args, 'ffmpeg_options', ''),
-                               getattr(args, 'ffmpeg_input_options', ''),
-                               getattr(args, 'ffmpeg_output_options', ''),
-                               logger
-                               )
-    bag_parser.parse_ros2bag()
+    bags = []
+    for pattern in args.input:
+        for bag in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.realpath(bag) not in bags:
+                bags.append(os.path.realpath(bag))
+
+    # options not given on the command line or in the config keep their defaults
+    options = {k: getattr(args, k) for k in DEFAULT_OPTIONS if getattr(args, k, None) is not None}
+    if 'topic_rates' in options:
+        options['topic_rates'] = dict(options['topic_rates'])
+    converter = BagConverter(logger, **options)
+
+    if len(bags) == 1:
+        bag_output_dirs = [os.path.realpath(args.output_dir)]
+    else:
+        bag_output_dirs = output_dirs(bags, args.output_dir)
+
+    if args.dry_run:
+        try:
+            for bag, output_dir in zip(bags, bag_output_dirs):
+                converter.parser(bag, output_dir).plan()
+        finally:
+            converter.close()
+    elif len(bags) == 1:
+        bag_parser = converter.parser(bags[0], bag_output_dirs[0])
+        progress = ProgressDisplay([bag_parser]) if args.progress else None
+        try:
+            bag_parser.parse_ros2bag()
+        finally:
+            if progress:
+                progress.close()
+            converter.close()
+    else:
+        bag_parsers = [converter.parser(b, o) for b, o in zip(bags, bag_output_dirs)]
+        progress = ProgressDisplay(bag_parsers) if args.progress else None
+        try:
+            failed = parse_bags(bag_parsers, converter.job_limits, converter.governor, logger)
+        finally:
+            if progress:
+                progress.close()
+        if failed:
+            sys.exit(1)
@@ -0,0 +1,417 @@
+import io
+import json
+import os
+import tarfile
+import types
+import zipfile
+
+import numpy as np
+import pytest
+
+import parse_ros2bag
+from parse_ros2bag import (BagIndex, Manifest, ParallelZip, ROS2BagParser, match_stamps, pcd_header,
+                           pointcloud_array, reopen_tar, reopen_zip, select_encoder)
+
+
+def test_match_stamps():
+    stamps = {'/a': np.array([0, 100, 200, 300]), '/b': np.array([5, 98, 260])}
+    matched = match_stamps(stamps, slop=10)
+    # 260 is too far from 200 and 300
+    assert matched.tolist() == [[0, 5], [100, 98]]
+
+
+def test_match_stamps_uses_messages_once():
+    # both /a messages are closest to the same /b message, only the first set keeps it
+    stamps = {'/a': np.array([100, 104]), '/b': np.array([102, 500, 600])}
+    assert match_stamps(stamps, slop=10).tolist() == [[100, 102]]
+
+
+def test_match_stamps_keeps_sets_after_dropped_ones():
+    # the 110 set reuses /b 104 and is dropped, the 120 set only shares /c 115 with that dropped set
+    stamps = {'/a': np.array([100, 110, 120]), '/b': np.array([104, 121, 300]), '/c': np.array([99, 115, 300])}
+    assert match_stamps(stamps, slop=20).tolist() == [[100, 104, 99], [120, 121, 115]]
+
+
+def test_match_stamps_empty_topic():
+    stamps = {'/a': np.array([0, 100]), '/b': np.array([], dtype=np.int64)}
+    assert match_stamps(stamps, slop=10).shape == (0, 2)
+
+
+def write_zip(path, entries):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for name, data in entries.items():
+            zipf.writestr(name, data)
+    with zipfile.ZipFile(path) as zipf:
+        return [zipf.getinfo(name) for name in entries]
+
+
+def read_zip(path):
+    with zipfile.ZipFile(path) as zipf:
+        assert zipf.testzip() is None
+        return {name: zipf.read(name) for name in zipf.namelist()}
+
+
+def test_reopen_zip_complete(tmp_path):
+    path = str(tmp_path / 'images.zip')
+    write_zip(path, {'a.png': b'a' * 1000})
+    with reopen_zip(path) as zipf:
+        zipf.writestr('b.png', b'b' * 1000)
+    assert read_zip(path) == {'a.png': b'a' * 1000, 'b.png': b'b' * 1000}
+
+
+def test_reopen_zip_without_central_directory(tmp_path):
+    path = str(tmp_path / 'images.zip')
+    infos = write_zip(path, {'a.png': b'a' * 1000, 'b.png': os.urandom(1000)})
+    # cut the central directory off, like a run killed before closing the archive
+    end = infos[1].header_offset + len(infos[1].FileHeader()) + infos[1].compress_size
+    os.truncate(path, end)
+    assert not zipfile.is_zipfile(path)
+
+    with reopen_zip(path) as zipf:
+        assert zipf.namelist() == ['a.png', 'b.png']
+        zipf.writestr('c.png', b'c' * 1000)
+    entries = read_zip(path)
+    assert list(entries) == ['a.png', 'b.png', 'c.png']
+    assert entries['a.png'] == b'a' * 1000
+
+
+def test_reopen_zip_drops_incomplete_entry(tmp_path):
+    path = str(tmp_path / 'images.zip')
+    infos = write_zip(path, {'a.png': b'a' * 1000, 'b.png': os.urandom(1000)})
+    # the second entry is only partly written
+    os.truncate(path, infos[1].header_offset + 100)
+
+    with reopen_zip(path) as zipf:
+        assert zipf.namelist() == ['a.png']
+        zipf.writestr('b.png', b'b' * 1000)
+    assert read_zip(path) == {'a.png': b'a' * 1000, 'b.png': b'b' * 1000}
+
+
+def test_reopen_zip_drops_interrupted_chunked_entry(tmp_path):
+    path = str(tmp_path / 'images.zip')
+    with open(path, 'w+b') as f:
+        zipf = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+        zipf.writestr('a.txt', b'a' * 1000)
+        # write_chunked's placeholder header, killed before it is rewritten
+        dest = zipf.open(zipfile.ZipInfo('b.txt'), 'w', force_zip64=True)
+        dest.write(os.urandom(1000))
+        f.flush()
+        with open(path, 'rb') as partial:
+            data = partial.read()
+        dest.close()
+        zipf.close()
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    with reopen_zip(path) as zipf:
+        assert zipf.namelist() == ['a.txt']
+    assert read_zip(path) == {'a.txt': b'a' * 1000}
+
+
+def test_parallel_zip_write_chunked(tmp_path, monkeypatch):
+    monkeypatch.setattr(ParallelZip, 'CHUNK_SIZE', 1024)
+    data = {'log.txt': b''.join(b'line %d\n' % i for i in range(2000)), 'empty.txt': b'',
+            'näme.txt': os.urandom(5000)}
+    for name, content in data.items():
+        with open(tmp_path / name, 'wb') as f:
+            f.write(content)
+
+    path = str(tmp_path / 'out.zip')
+    with ParallelZip(path, workers=2) as archive:
+        for name in data:
+            archive.write(str(tmp_path / name), name)
+    with zipfile.ZipFile(path) as zipf:
+        assert zipf.getinfo('log.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert zipf.getinfo('log.txt').compress_size < len(data['log.txt'])
+    assert read_zip(path) == data
+
+    # the rewritten local headers are enough to recover the entries without the central directory
+    with zipfile.ZipFile(path) as zipf:
+        os.truncate(path, zipf.start_dir)
+    with ParallelZip(path, resume=True, workers=2) as archive:
+        assert archive.namelist() == list(data)
+        archive.writestr('more.txt', b'more')
+    assert read_zip(path) == {**data, 'more.txt': b'more'}
+
+
+def write_output(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_manifest_done(tmp_path):
+    output = write_output(tmp_path / 'sync_index.csv', b'stamps')
+    manifest = Manifest(str(tmp_path), 'bag')
+    assert not manifest.done('sync')
+    manifest.start('sync')
+    assert not manifest.done('sync')
+    manifest.finish('sync', [output])
+
+    resumed = Manifest(str(tmp_path), 'bag', resume=True)
+    assert resumed.done('sync')
+    write_output(output, b'other stamps')
+    assert not resumed.done('sync')
+    os.remove(output)
+    assert not resumed.done('sync')
+
+
+def test_manifest_other_bag(tmp_path):
+    Manifest(str(tmp_path), 'bag')
+    with pytest.raises(ValueError):
+        Manifest(str(tmp_path), 'other_bag', resume=True)
+
+
+def test_manifest_checksums(tmp_path):
+    output = write_output(tmp_path / 'pictures.zip', b'aaaa')
+    Manifest(str(tmp_path), 'bag', checksums=True).finish('zip', [output])
+
+    # same size and modification time, different content
+    stat = os.stat(output)
+    write_output(output, b'bbbb')
+    os.utime(output, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert Manifest(str(tmp_path), 'bag', resume=True).done('zip')
+    assert not Manifest(str(tmp_path), 'bag', resume=True, checksums=True).done('zip')
+
+
+def test_manifest_legacy_checksums(tmp_path):
+    output = write_output(tmp_path / 'pictures.zip', b'aaaa')
+    manifest = Manifest(str(tmp_path), 'bag', checksums=True)
+    manifest.finish('zip', [output])
+    # older runs stored only the checksum of every output
+    with open(manifest.path) as f:
+        stored = json.load(f)
+    stored['stages']['zip']['outputs'] = {name: fingerprint['sha256']
+                                          for name, fingerprint in stored['stages']['zip']['outputs'].items()}
+    with open(manifest.path, 'w') as f:
+        json.dump(stored, f)
+
+    assert Manifest(str(tmp_path), 'bag', resume=True).done('zip')
+    write_output(output, b'bbbb')
+    assert not Manifest(str(tmp_path), 'bag', resume=True).done('zip')
+
+
+def test_manifest_start_keeps_progress(tmp_path):
+    manifest = Manifest(str(tmp_path), 'bag')
+    manifest.start('export')
+    manifest.advance('export', '/cam', 100)
+    manifest.advance('export', '/cam', 200)
+    manifest.save()
+
+    resumed = Manifest(str(tmp_path), 'bag', resume=True)
+    resumed.start('export')
+    assert resumed.stages['export']['topics'] == {'/cam': {'frames': 2, 'last_stamp': 200}}
+    # a finished stage that is redone starts over
+    resumed.finish('export')
+    resumed.start('export')
+    assert resumed.stages['export']['topics'] == {}
+
+
+def test_recover_frames(tmp_path):
+    # a parser after prepare, resuming into a folder of exported frames
+    parser = ROS2BagParser.__new__(ROS2BagParser)
+    parser.image_path = str(tmp_path / 'images')
+    parser.blurred_path = None
+    parser.image_archiver = None
+    parser.zip = False
+    parser.frames = {'/cam/image': {}}
+    os.makedirs(tmp_path / 'images' / 'cam' / 'image')
+    for name in ('100.png', '200.png', '300.part.png'):
+        write_output(tmp_path / 'images' / 'cam' / 'image' / name, b'png')
+
+    parser.recover_frames()
+    assert parser.frames['/cam/image'] == {100: parser.image_path + '/cam/image/100.png',
+                                           200: parser.image_path + '/cam/image/200.png'}
+
+
+def write_tar(path, entries):
+    with tarfile.open(path, 'w') as tarf:
+        for name, data in entries.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tarf.addfile(info, io.BytesIO(data))
+
+
+def write_tar_member(path, name, data):
+    with tarfile.open(path, 'a') as tarf:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tarf.addfile(info, io.BytesIO(data))
+
+
+def read_tar(path):
+    with tarfile.open(path) as tarf:
+        return {m.name: tarf.extractfile(m).read() for m in tarf.getmembers()}
+
+
+def test_reopen_tar_complete(tmp_path):
+    path = str(tmp_path / 'images.tar')
+    write_tar(path, {'a.png': b'a' * 1000})
+    with reopen_tar(path) as tarf:
+        assert tarf.getnames() == ['a.png']
+    write_tar_member(path, 'b.png', b'b' * 10)
+    assert read_tar(path) == {'a.png': b'a' * 1000, 'b.png': b'b' * 10}
+
+
+def test_reopen_tar_drops_incomplete_member(tmp_path):
+    path = str(tmp_path / 'images.tar')
+    write_tar(path, {'a.png': b'a' * 1000, 'b.png': b'b' * 2000})
+    # the second member's data is only partly written and there is no end of archive marker
+    os.truncate(path, 512 + 1024 + 512 + 1000)
+
+    with reopen_tar(path) as tarf:
+        assert tarf.getnames() == ['a.png']
+    write_tar_member(path, 'c.png', b'c' * 10)
+    assert read_tar(path) == {'a.png': b'a' * 1000, 'c.png': b'c' * 10}
+
+
+def test_reopen_tar_long_name(tmp_path):
+    # the long name header is cut off together with the member it belongs to
+    path = str(tmp_path / 'images.tar')
+    name = 'x' * 200 + '.png'
+    write_tar(path, {'a.png': b'a' * 10, name: b'b' * 2000})
+    # a.png, the pax header holding the long name, then part of the member's data
+    os.truncate(path, 2 * 512 + 2 * 512 + 512 + 1000)
+
+    with reopen_tar(path) as tarf:
+        assert tarf.getnames() == ['a.png']
+
+
+def point_field(name, offset, datatype, count=1):
+    return types.SimpleNamespace(name=name, offset=offset, datatype=datatype, count=count)
+
+
+def cloud(points, fields, point_step, width, height, row_step=None, is_bigendian=False):
+    return types.SimpleNamespace(fields=fields, point_step=point_step, width=width, height=height,
+                                 row_step=row_step or width * point_step, is_bigendian=is_bigendian,
+                                 data=points.tobytes())
+
+
+def test_pointcloud_array():
+    # x, y, z, 4 padding bytes, intensity and an unknown field type that is skipped
+    dtype = np.dtype({'names': ['x', 'y', 'z', 'intensity', 'ring'], 'formats': ['<f4', '<f4', '<f4', '<u2', '<u1'],
+                      'offsets': [0, 4, 8, 16, 18], 'itemsize': 20})
+    data = np.zeros(3, dtype=dtype)
+    data['x'], data['y'], data['z'] = [1, 2, 3], [4, 5, 6], [7, 8, 9]
+    data['intensity'] = [10, 20, 30]
+    fields = [point_field('x', 0, 7), point_field('y', 4, 7), point_field('z', 8, 7),
+              point_field('intensity', 16, 4), point_field('ring', 18, 42)]
+
+    points = pointcloud_array(cloud(data, fields, 20, 3, 1))
+    assert points.dtype.names == ('x', 'y', 'z', 'intensity')
+    assert points.dtype.itemsize == 14
+    assert points['x'].tolist() == [1, 2, 3]
+    assert points['intensity'].tolist() == [10, 20, 30]
+
+
+def test_pointcloud_array_big_endian_padded_rows():
+    dtype = np.dtype([('x', '>f4'), ('rgb', '>u1', (3,))])
+    rows = np.zeros(4, dtype=dtype)
+    rows['x'] = [1.5, 2.5, 3.5, 4.5]
+    rows['rgb'] = [[1, 2, 3]] * 4
+    # 2 x 2 points, every row padded by 5 bytes
+    data = b''.join(rows[i:i + 2].tobytes() + bytes(5) for i in (0, 2))
+    msg = types.SimpleNamespace(fields=[point_field('x', 0, 7), point_field('rgb', 4, 2, 3)], point_step=7,
+                                width=2, height=2, row_step=19, is_bigendian=True, data=data)
+
+    points = pointcloud_array(msg)
+    assert points['x'].dtype.isnative
+    assert points['x'].tolist() == [1.5, 2.5, 3.5, 4.5]
+    assert points['rgb'].tolist() == [[1, 2, 3]] * 4
+
+
+def test_pcd_header():
+    points = np.zeros(6, dtype=[('x', 'f4'), ('y', 'f8'), ('intensity', 'u2'), ('rgb', 'u1', (3,)), ('ring', 'i1')])
+    header = pcd_header(points, 3, 2, 'binary').decode()
+    assert header == ('VERSION .7\n'
+                      'FIELDS x y intensity rgb ring\n'
+                      'SIZE 4 8 2 1 1\n'
+                      'TYPE F F U U I\n'
+                      'COUNT 1 1 1 3 1\n'
+                      'WIDTH 3\n'
+                      'HEIGHT 2\n'
+                      'VIEWPOINT 0 0 0 1 0 0 0\n'
+                      'POINTS 6\n'
+                      'DATA binary\n')
+
+
+def make_index(topics):
+    # an index over given receive timestamps, without a bag behind it
+    index = BagIndex.__new__(BagIndex)
+    index.logger = None
+    index.filtered = False
+    index.topics = {}
+    for name, timestamps in topics.items():
+        timestamps = np.array(timestamps, dtype=np.int64)
+        index.topics[name] = {'type': 'std_msgs/msg/String', 'files': np.zeros(len(timestamps), dtype=np.int64),
+                              'ids': np.arange(1, len(timestamps) + 1), 'timestamps': timestamps, 'stamps': None}
+    return index
+
+
+def seconds(*values):
+    return [int(v * 1e9) for v in values]
+
+
+def test_apply_filters_without_filters():
+    index = make_index({'/a': seconds(0, 1, 2)})
+    index.apply_filters()
+    assert not index.filtered
+    assert index.topics['/a']['ids'].tolist() == [1, 2, 3]
+
+
+def test_apply_filters_time_window():
+    # start and end are relative to the first message of any topic
+    index = make_index({'/a': seconds(10, 11, 12, 13, 14), '/b': seconds(10.5, 12.5, 14.5)})
+    index.apply_filters(start=1, end=3)
+    assert index.filtered
+    assert index.topics['/a']['ids'].tolist() == [2, 3]
+    assert index.topics['/b']['ids'].tolist() == [2]
+    assert index.topics['/b']['stamps'] is None
+
+
+def test_apply_filters_decimation_and_max_messages():
+    index = make_index({'/a': seconds(*range(10))})
+    index.apply_filters(decimation=3, max_messages=3)
+    assert index.topics['/a']['ids'].tolist() == [1, 4, 7]
+
+
+def test_apply_filters_rates():
+    index = make_index({'/a': seconds(*np.arange(0, 2, 0.1)), '/b': seconds(*np.arange(0, 2, 0.1))})
+    index.apply_filters(max_rate=2, topic_rates={'/b': 1})
+    assert index.topics['/a']['ids'].tolist() == [1, 6, 11, 16]
+    assert index.topics['/b']['ids'].tolist() == [1, 11]
+
+
+def test_apply_filters_unsorted_timestamps():
+    # rows of a multi file bag aren't necessarily in receive time order, the filtered index is
+    index = make_index({'/a': seconds(2, 0, 1, 3)})
+    index.apply_filters(start=1, end=3)
+    assert index.topics['/a']['ids'].tolist() == [3, 1]
+
+
+OUTPUT_OPTIONS = '-vf scale=1920:-2 -c:v hevc_nvenc -preset slow -qp 17 -pix_fmt yuv420p'
+
+
+@pytest.fixture
+def encoders(monkeypatch):
+    # probe results without running ffmpeg
+    working = {'hevc_nvenc': True, 'h264_nvenc': False, 'h264_qsv': True, 'h264_videotoolbox': False, 'libx264': True}
+    monkeypatch.setattr(parse_ros2bag, 'working_encoders', working)
+    return working
+
+
+def test_select_encoder_given(encoders):
+    assert select_encoder(OUTPUT_OPTIONS) == (OUTPUT_OPTIONS.split(), 'hevc_nvenc')
+
+
+def test_select_encoder_auto(encoders):
+    # the encoder of the output options is dropped with its options even if it works
+    assert select_encoder(OUTPUT_OPTIONS, 'auto') == (
+        ['-vf', 'scale=1920:-2', '-pix_fmt', 'yuv420p', '-c:v', 'h264_qsv', '-global_quality', '23'], 'h264_qsv')
+
+
+def test_select_encoder_unavailable(encoders):
+    encoders['hevc_nvenc'] = False
+    assert select_encoder(OUTPUT_OPTIONS)[1] == 'h264_qsv'
+    assert select_encoder(OUTPUT_OPTIONS, 'libx264') == (
+        ['-vf', 'scale=1920:-2', '-pix_fmt', 'yuv420p', '-c:v', 'libx264', '-preset', 'fast', '-crf', '23'], 'libx264')